@@ -1,525 +1,3796 @@
-# advancing_query_bot.py
-# Telegram бот за дневни списъци по ОФИС/Topic (форум нишки) – независим списък и напомняне за всеки Topic.
-# Всяка сутрин ботът праща "Дата ..." + съобщение "Днешният списък:", което се ОБНОВЯВА при всяко добавяне.
-# Добавен е интерактивен /edit уизард с бутони (Смени/Изтрий/Вмъкни/Премести). Потребителските съобщения се изтриват.
-# Зависимости: python-telegram-bot[job-queue]==21.4, tzdata (за Windows)
-
-import json
-import os
-from datetime import datetime, time
-from typing import Dict, List, Optional
-
-# Часова зона: Europe/Sofia (fallback към локалната, ако липсва tzdata на Windows)
-try:
-    from zoneinfo import ZoneInfo
-    TIMEZONE = ZoneInfo("Europe/Sofia")
-except Exception:
-    TIMEZONE = datetime.now().astimezone().tzinfo
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    CallbackQueryHandler,
-    filters,
-)
-
-# ======================= НАСТРОЙКИ ==========================
-import os
-TOKEN = os.getenv("TOKEN", "").strip()
-DAILY_HOUR = 10  # 10:00 местно време
-DATA_FILE = "order_data.json"
-SEP = "#"
-# ============================================================
-
-# ------------------ СЪХРАНЕНИЕ ------------------
-def topic_key(chat_id: int, thread_id: Optional[int]) -> str:
-    return f"{chat_id}{SEP}{thread_id if thread_id is not None else 0}"
-
-def load_data() -> Dict:
-    if not os.path.exists(DATA_FILE):
-        return {"enabled_topics": [], "lists": {}, "list_msgs": {}}
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            data.setdefault("enabled_topics", [])
-            data.setdefault("lists", {})
-            data.setdefault("list_msgs", {})
-            return data
-    except Exception:
-        return {"enabled_topics": [], "lists": {}, "list_msgs": {}}
-
-def save_data(data: Dict) -> None:
-    tmp = DATA_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, DATA_FILE)
-
-def today_key() -> str:
-    return datetime.now(TIMEZONE).strftime("%Y-%m-%d")
-
-def render_list_text(items: List[str]) -> str:
-    header = "Днешният списък:"
-    if not items:
-        return header
-    bullets = "\n".join("• " + x for x in items)
-    return f"{header}\n{bullets}"
-
-def append_item(k: str, item: str) -> None:
-    data = load_data()
-    lists = data.setdefault("lists", {})
-    topic_lists = lists.setdefault(k, {})
-    day = today_key()
-    topic_lists.setdefault(day, [])
-    if item.strip():
-        topic_lists[day].append(item.strip())
-    save_data(data)
-
-def clear_today(k: str) -> None:
-    data = load_data()
-    lists = data.setdefault("lists", {})
-    lists.setdefault(k, {})[today_key()] = []
-    save_data(data)
-
-def get_today(k: str) -> List[str]:
-    data = load_data()
-    return data.get("lists", {}).get(k, {}).get(today_key(), [])
-
-def set_today_list(k: str, items: List[str]) -> None:
-    data = load_data()
-    lists = data.setdefault("lists", {})
-    topic_lists = lists.setdefault(k, {})
-    topic_lists[today_key()] = items
-    save_data(data)
-
-def set_list_message_id(k: str, message_id: int) -> None:
-    data = load_data()
-    lm = data.setdefault("list_msgs", {})
-    per_topic = lm.setdefault(k, {})
-    per_topic[today_key()] = int(message_id)
-    save_data(data)
-
-def get_list_message_id(k: str) -> Optional[int]:
-    data = load_data()
-    msg_id = data.get("list_msgs", {}).get(k, {}).get(today_key())
-    return int(msg_id) if msg_id is not None else None
-
-def enable_topic(chat_id: int, thread_id: Optional[int]) -> None:
-    data = load_data()
-    k = topic_key(chat_id, thread_id)
-    if k not in data["enabled_topics"]:
-        data["enabled_topics"].append(k)
-        save_data(data)
-
-def disable_topic(chat_id: int, thread_id: Optional[int]) -> None:
-    data = load_data()
-    k = topic_key(chat_id, thread_id)
-    if k in data["enabled_topics"]:
-        data["enabled_topics"].remove(k)
-        save_data(data)
-
-# ------------------ ПОМОЩНИЦИ ------------------
-async def send_in_topic(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], text: str):
-    kwargs = {"chat_id": chat_id, "text": text}
-    if thread_id is not None and thread_id != 0:
-        kwargs["message_thread_id"] = thread_id
-    return await context.bot.send_message(**kwargs)
-
-async def ensure_list_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> int:
-    msg_id = get_list_message_id(k)
-    if msg_id is None:
-        sent = await send_in_topic(context, chat_id, thread_id, render_list_text(get_today(k)))
-        set_list_message_id(k, sent.message_id)
-        return sent.message_id
-    return msg_id
-
-async def update_list_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> None:
-    msg_id = get_list_message_id(k)
-    text = render_list_text(get_today(k))
-    if msg_id is None:
-        sent = await send_in_topic(context, chat_id, thread_id, text)
-        set_list_message_id(k, sent.message_id)
-        return
-    try:
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=text)
-    except Exception:
-        sent = await send_in_topic(context, chat_id, thread_id, text)
-        set_list_message_id(k, sent.message_id)
-
-# ------------------ JOB ------------------
-async def daily_prompt_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job_data = context.job.data or {}
-    chat_id = job_data.get("chat_id")
-    thread_id = job_data.get("thread_id")
-    k = topic_key(chat_id, thread_id)
-
-    clear_today(k)
-    today = datetime.now(TIMEZONE).strftime("%d.%m.%Y")
-    header = f"Дата {today}, списък за изпращане :"
-    try:
-        await send_in_topic(context, chat_id, thread_id if thread_id != 0 else None, header)
-        await ensure_list_message(context, chat_id, (thread_id if thread_id != 0 else None), k)
-        await update_list_message(context, chat_id, (thread_id if thread_id != 0 else None), k)
-    except Exception:
-        pass
-
-# ------------------ HANDЛЕРИ ------------------
-async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-    msg = """Здравей! Ботът работи по Topics.
-Пусни /enable във ВСЕКИ офис-Topic, за да има отделен списък и дневно съобщение в 10:00.
-
-Команди в текущия Topic:
-• /enable – включва дневното съобщение и списък за тази нишка
-• /disable – спира дневното съобщение за тази нишка
-• /show – показва днешния списък за тази нишка
-• /clear – изчиства днешния списък за тази нишка
-• /edit – интерактивна редакция с бутони (Смени/Изтрий/Вмъкни/Премести)
-• Пишете артикул като текст – ще бъде изтрит и добавен към списъка на тази нишка (и ще се редактира „Днешният списък:“).
-"""
-    await send_in_topic(context, update.effective_chat.id, thread_id, msg)
-
-async def enable_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if context.job_queue is None:
-        await update.effective_message.reply_text(
-            "Нужно е да инсталираш python-telegram-bot[job-queue], за да работи дневното напомняне.")
-        return
-    chat_id = update.effective_chat.id
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-    k = topic_key(chat_id, thread_id)
-    enable_topic(chat_id, thread_id)
-    job_name = f"daily_{chat_id}_{thread_id if thread_id is not None else 0}"
-    for job in context.job_queue.get_jobs_by_name(job_name):
-        job.schedule_removal()
-    context.job_queue.run_daily(
-        daily_prompt_job,
-        time=time(hour=DAILY_HOUR, minute=0, tzinfo=TIMEZONE),
-        name=job_name,
-        data={"chat_id": chat_id, "thread_id": (thread_id if thread_id is not None else 0)},
-    )
-    await ensure_list_message(context, chat_id, thread_id, k)
-    await send_in_topic(context, chat_id, thread_id, "Готово! Този Topic е активиран за 10:00 и има собствен списък.")
-
-async def disable_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-    disable_topic(chat_id, thread_id)
-    if context.job_queue is not None:
-        job_name = f"daily_{chat_id}_{thread_id if thread_id is not None else 0}"
-        for job in context.job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
-    await send_in_topic(context, chat_id, thread_id, "Този Topic е деактивиран за дневното съобщение.")
-
-async def show_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-    k = topic_key(chat_id, thread_id)
-    await ensure_list_message(context, chat_id, thread_id, k)
-    await update_list_message(context, chat_id, thread_id, k)
-
-async def clear_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-    k = topic_key(chat_id, thread_id)
-    clear_today(k)
-    await update_list_message(context, chat_id, thread_id, k)
-
-async def delete_message_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = context.job.data or {}
-    chat_id = data.get("chat_id")
-    msg_id = data.get("message_id")
-    if chat_id and msg_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-        except Exception:
-            pass
-
-async def capture_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = update.effective_message
-    chat = update.effective_chat
-    thread_id = getattr(msg, "message_thread_id", None)
-    k = topic_key(chat.id, thread_id)
-
-    # ❗ Обработваме текст САМО ако този Topic е активиран с /enable
-    data = load_data()
-    if k not in data.get("enabled_topics", []):
-        return  # нищо не правим – без изтриване, без добавяне
-
-    text_in = (msg.text or "").strip()
-    if not text_in:
-        return
-
-    # Проверка дали чакаме текст за уизарда /edit (set/ins)
-    state_key = f"edit:{k}"
-    state = context.user_data.get(state_key)
-    if state and state.get("await") == "text":
-        mode = state.get("mode")
-        idx = state.get("index")
-        items = get_today(k)
-        changed = False
-        notice = None
-
-        if mode == "set":
-            if idx and 1 <= idx <= len(items):
-                items[idx - 1] = text_in
-                changed = True
-                notice = f"✅ Ред {idx} е обновен."
-        elif mode == "ins":
-            if idx and 1 <= idx <= len(items) + 1:
-                items.insert(idx - 1, text_in)
-                changed = True
-                notice = f"✅ Вмъкнато преди позиция {idx}."
-
-        context.user_data.pop(state_key, None)
-
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-
-        if changed:
-            set_today_list(k, items)
-            await ensure_list_message(context, chat.id, thread_id, k)
-            await update_list_message(context, chat.id, thread_id, k)
-            try:
-                sent = await send_in_topic(context, chat.id, thread_id, notice or "Обнових списъка.")
-                if context.job_queue is not None:
-                    context.job_queue.run_once(
-                        delete_message_job, when=5, data={"chat_id": chat.id, "message_id": sent.message_id}
-                    )
-            except Exception:
-                pass
-        else:
-            await send_in_topic(context, chat.id, thread_id, "Невалидна позиция за редакция.")
-        return
-
-    # Обичайното поведение: артикул за добавяне
-    try:
-        await msg.delete()
-    except Exception:
-        pass
-
-    append_item(k, text_in)
-
-    try:
-        await ensure_list_message(context, chat.id, thread_id, k)
-        await update_list_message(context, chat.id, thread_id, k)
-    except Exception:
-        pass
-
-    try:
-        sent = await send_in_topic(context, chat.id, thread_id, "Списъкът е обновен.")
-        if context.job_queue is not None:
-            context.job_queue.run_once(
-                delete_message_job,
-                when=3,
-                data={"chat_id": chat.id, "message_id": sent.message_id},
-            )
-    except Exception:
-        pass
-
-# ---------- /edit уизард (бутони) ----------
-async def edit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Стартира интерактивен уизард за редакция с бутони в текущия Topic."""
-    chat_id = update.effective_chat.id
-    thread_id = getattr(update.effective_message, "message_thread_id", None)
-
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Смени", callback_data="edit_set"),
-            InlineKeyboardButton("🗑️ Изтрий", callback_data="edit_del"),
-        ],
-        [
-            InlineKeyboardButton("➕ Вмъкни", callback_data="edit_ins"),
-            InlineKeyboardButton("↔️ Премести", callback_data="edit_move"),
-        ],
-        [InlineKeyboardButton("❌ Откажи", callback_data="edit_cancel")],
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
-
-    await send_in_topic(
-        context,
-        chat_id,
-        thread_id,
-        """Какво искаш да направиш със списъка?
-(Избери действие от бутоните)""",
-    )
-    await update.effective_message.reply_text("Избери действие:", reply_markup=markup)
-
-
-def _index_keyboard(n: int, prefix: str) -> InlineKeyboardMarkup:
-    # Генерира клавиатура 1..n с бутони, по 5 на ред
-    n = max(0, int(n))
-    rows = []
-    row = []
-    for i in range(1, n + 1):
-        row.append(InlineKeyboardButton(str(i), callback_data=f"{prefix}_{i}"))
-        if len(row) == 5:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
-    rows.append([InlineKeyboardButton("Откажи", callback_data="edit_cancel")])
-    return InlineKeyboardMarkup(rows)
-
-
-async def on_edit_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-    data = query.data  # edit_set/del/ins/move/cancel
-
-    chat = query.message.chat
-    thread_id = getattr(query.message, "message_thread_id", None)
-    k = topic_key(chat.id, thread_id)
-
-    if data == "edit_cancel":
-        context.user_data.pop(f"edit:{k}", None)
-        await query.edit_message_text("❌ Отказано.")
-        return
-
-    mode = data.split("_", 1)[1]  # set/del/ins/move
-    items = get_today(k)
-
-    if mode in ("set", "del", "move") and not items:
-        await query.edit_message_text("Няма редове за редакция. Използвай ➕ Вмъкни.")
-        return
-
-    context.user_data[f"edit:{k}"] = {"mode": mode}
-
-    if mode == "set":
-        await query.edit_message_text("Избери кой ред да сменя:", reply_markup=_index_keyboard(len(items), "pick"))
-    elif mode == "del":
-        await query.edit_message_text("Избери кой ред да изтрия:", reply_markup=_index_keyboard(len(items), "pick"))
-    elif mode == "ins":
-        await query.edit_message_text(
-            "Избери ПРЕД коя позиция да вмъкна (или последната за накрая):",
-            reply_markup=_index_keyboard(len(items) + 1, "pick"),
-        )
-    elif mode == "move":
-        await query.edit_message_text("Избери кой ред да преместя:", reply_markup=_index_keyboard(len(items), "pick"))
-
-
-async def on_pick_index(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-
-    data = query.data  # pick_N
-    idx = int(data.split("_", 1)[1])
-    chat = query.message.chat
-    thread_id = getattr(query.message, "message_thread_id", None)
-    k = topic_key(chat.id, thread_id)
-
-    state_key = f"edit:{k}"
-    state = context.user_data.get(state_key) or {}
-    mode = state.get("mode")
-    items = get_today(k)
-
-    if mode == "del":
-        if 1 <= idx <= len(items):
-            removed = items.pop(idx - 1)
-            set_today_list(k, items)
-            await update_list_message(context, chat.id, thread_id, k)
-            await query.edit_message_text(f"✅ Изтрих ред {idx}: {removed}")
-        else:
-            await query.edit_message_text("Невалиден индекс.")
-        context.user_data.pop(state_key, None)
-        return
-
-    if mode == "set":
-        context.user_data[state_key] = {"mode": "set", "await": "text", "index": idx}
-        await query.edit_message_text(f"Изпрати новия текст за ред {idx} като съобщение.")
-        return
-
-    if mode == "ins":
-        context.user_data[state_key] = {"mode": "ins", "await": "text", "index": idx}
-        await query.edit_message_text(
-            f"Изпрати текст за вмъкване ПРЕДИ позиция {idx} (или последна за накрая)."
-        )
-        return
-
-    if mode == "move":
-        context.user_data[state_key] = {"mode": "move", "await": "toindex", "from": idx}
-        await query.edit_message_text("Избери НОВА позиция:", reply_markup=_index_keyboard(len(items), "pickto"))
-        return
-
-    await query.edit_message_text("Неподдържано действие.")
-
-
-async def on_pick_to_index(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-
-    data = query.data  # pickto_N
-    dst = int(data.split("_", 1)[1])
-    chat = query.message.chat
-    thread_id = getattr(query.message, "message_thread_id", None)
-    k = topic_key(chat.id, thread_id)
-
-    state_key = f"edit:{k}"
-    state = context.user_data.get(state_key) or {}
-    src = state.get("from")
-    items = get_today(k)
-
-    if not src or not (1 <= src <= len(items)) or not (1 <= dst <= len(items)):
-        await query.edit_message_text("Невалидни позиции.")
-        context.user_data.pop(state_key, None)
-        return
-
-    if src == dst:
-        await query.edit_message_text("Позициите съвпадат – няма промяна.")
-        context.user_data.pop(state_key, None)
-        return
-
-    itm = items.pop(src - 1)
-    items.insert(dst - 1, itm)
-    set_today_list(k, items)
-    await update_list_message(context, chat.id, thread_id, k)
-
-    await query.edit_message_text(f"✅ Преместих ред {src} → {dst}.")
-    context.user_data.pop(state_key, None)
-
-# ------------------ MAIN ------------------
-def main() -> None:
-    if not TOKEN or TOKEN == "PUT_YOUR_TELEGRAM_BOT_TOKEN_HERE":
-        raise RuntimeError("Моля, постави валиден TOKEN в променливата TOKEN в кода.")
-    app = Application.builder().token(TOKEN).build()
-
-    data = load_data()
-    if app.job_queue is not None:
-        for k in data.get("enabled_topics", []):
-            try:
-                chat_id_str, thread_str = k.split(SEP, 1)
-                chat_id = int(chat_id_str)
-                thread_id = int(thread_str)
-            except Exception:
-                continue
-            job_name = f"daily_{chat_id}_{thread_id}"
-            for job in app.job_queue.get_jobs_by_name(job_name):
-                job.schedule_removal()
-            app.job_queue.run_daily(
-                daily_prompt_job,
-                time=time(hour=DAILY_HOUR, minute=0, tzinfo=TIMEZONE),
-                name=job_name,
-                data={"chat_id": chat_id, "thread_id": thread_id},
-            )
-
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("enable", enable_cmd))
-    app.add_handler(CommandHandler("disable", disable_cmd))
-    app.add_handler(CommandHandler("show", show_cmd))
-    app.add_handler(CommandHandler("clear", clear_cmd))
-    app.add_handler(CommandHandler("edit", edit_cmd))
-
-    app.add_handler(CallbackQueryHandler(on_edit_action, pattern=r"^edit_(set|del|ins|move|cancel)$"))
-    app.add_handler(CallbackQueryHandler(on_pick_index, pattern=r"^pick_([0-9]+)$"))
-    app.add_handler(CallbackQueryHandler(on_pick_to_index, pattern=r"^pickto_([0-9]+)$"))
-
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, capture_text))
-
-    print("Bot is running… Press Ctrl+C to stop.")
-    app.run_polling(close_loop=False)
-
-if __name__ == "__main__":
-    main()
+# advancing_query_bot.py
+# Telegram бот за дневни списъци по ОФИС/Topic (форум нишки) – независим списък и напомняне за всеки Topic.
+# Всяка сутрин ботът праща "Дата ..." + съобщение "Днешният списък:", което се ОБНОВЯВА при всяко добавяне.
+# Добавен е интерактивен /edit уизард с бутони (Смени/Изтрий/Вмъкни/Премести). Потребителските съобщения се изтриват.
+# Зависимости: python-telegram-bot[job-queue]==21.4, tzdata (за Windows)
+
+import argparse
+import asyncio
+import atexit
+import bisect
+import copy
+import cProfile
+import csv
+import functools
+import gzip
+import heapq
+import hmac
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import traceback
+import zlib
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta, timezone
+from time import monotonic, perf_counter, time as time_now
+from typing import IO, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Часова зона: Europe/Sofia (fallback към локалната, ако липсва tzdata на Windows)
+try:
+    from zoneinfo import ZoneInfo
+    TIMEZONE = ZoneInfo("Europe/Sofia")
+except Exception:
+    TIMEZONE = datetime.now().astimezone().tzinfo
+
+import httpx
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    MessageHandler,
+    ContextTypes,
+    CallbackQueryHandler,
+    filters,
+)
+
+# ======================= НАСТРОЙКИ ==========================
+import os
+TOKEN = os.getenv("TOKEN", "").strip()
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()  # празно → https://api.telegram.org
+DAILY_HOUR = 10  # 10:00 местно време
+DATA_FILE = os.getenv("DATA_FILE", "order_data.json")
+SEP = "#"
+# Telegram user id-та с достъп до командите за поддръжка (/prune и др.), разделени със запетая
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# ============================================================
+
+logger = logging.getLogger(__name__)
+
+# ------------------ МЕТРИКИ ------------------
+# METRICS=1 включва измерването: латентност на handler-ите, време/байтове на хранилището,
+# Bot API извиквания/грешки/RetryAfter по метод и закъснение на JobQueue. Данните се четат
+# в Prometheus формат от GET /metrics (webhook сървъра или METRICS_PORT при polling) и се
+# логват на всеки METRICS_LOG_INTERVAL сек. Изключено → декораторите връщат функцията както е.
+METRICS_ENABLED = os.getenv("METRICS", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(_LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(_LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Metrics:
+    HELP = {
+        "bot_handler_seconds": "Latency of update handlers and jobs",
+        "bot_handler_errors_total": "Handlers that raised",
+        "bot_storage_seconds": "Storage load/save duration",
+        "bot_storage_bytes_total": "Bytes read/written by storage",
+        "bot_api_seconds": "Bot API call duration",
+        "bot_api_queue_seconds": "Time a Bot API call waited in the scheduler queue",
+        "bot_api_calls_total": "Bot API calls",
+        "bot_api_errors_total": "Bot API calls that failed",
+        "bot_api_retry_after_seconds_total": "Seconds spent waiting on RetryAfter",
+        "bot_job_lag_seconds": "Delay between scheduled and actual JobQueue run",
+        "bot_loop_lag_seconds": "How late the event loop heartbeat ran",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()  # хранилището пише и от фоновия поток
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], _Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = _Histogram()
+            hist.observe(value)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        def fmt(labels: Tuple, extra: Tuple = ()) -> str:
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(
+                '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs
+            ) + "}"
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines += [f"# HELP {name} {self.HELP.get(name, name)}", f"# TYPE {name} counter"]
+                lines.append(f"{name}{fmt(labels)} {value:g}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines += [f"# HELP {name} {self.HELP.get(name, name)}", f"# TYPE {name} histogram"]
+                cumulative = 0
+                for bound, count in zip(_LATENCY_BUCKETS, hist.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {hist.count}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist.total:.6f}")
+                lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Кратък ред за лога: брой и средно време по handler/метод."""
+        parts = []
+        with self._lock:
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name in ("bot_handler_seconds", "bot_api_seconds", "bot_storage_seconds") and hist.count:
+                    label = ",".join(str(v) for _, v in labels)
+                    parts.append(f"{name[4:-8]}[{label}] n={hist.count} avg={hist.total / hist.count * 1000:.1f}ms")
+            errors = sum(v for (n, _), v in self.counters.items() if n.endswith("errors_total"))
+        return "; ".join(parts) + f"; errors={errors:g}"
+
+METRICS = Metrics()
+
+def instrumented(func):
+    """Мери латентността на async handler/job (при METRICS=1) и го отбелязва като активен
+    за наблюдателя на event loop-а (при LOOP_LAG_THRESHOLD > 0)."""
+    if not METRICS_ENABLED and LOOP_LAG_THRESHOLD <= 0:
+        return func
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        token = next(_HANDLER_TOKENS)
+        _ACTIVE_HANDLERS[token] = (name, started)
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            if METRICS_ENABLED:
+                METRICS.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            del _ACTIVE_HANDLERS[token]
+            if METRICS_ENABLED:
+                METRICS.observe("bot_handler_seconds", perf_counter() - started, handler=name)
+    return wrapper
+
+def _storage_metric(op: str, started: float, nbytes: int = 0) -> None:
+    METRICS.observe("bot_storage_seconds", perf_counter() - started, op=op)
+    if nbytes:
+        METRICS.inc("bot_storage_bytes_total", nbytes, op=op)
+
+# ------------------ ПРОФИЛИРАНЕ ------------------
+# /profile [сек] (само за ADMIN_IDS) пуска cProfile върху нишката на event loop-а за ограничен
+# прозорец и връща най-тежките функции като файл. Там работят handler-ите, помощниците за
+# списъка и хранилището (без фоновите му потоци). cProfile не брои времето, в което корутина
+# чака await, затова отчетът показва отделно и реалното време в Bot API извиквания.
+#
+# Наблюдателят на event loop-а се включва по избор, като METRICS: LOOP_LAG_THRESHOLD сек.
+# (по подразбиране 0 → изключен и instrumented връща handler-ите непроменени). Той е пулс на
+# всеки LOOP_LAG_INTERVAL сек. плюс поток-пазач. Ако пулсът закъснее над прага, пазачът снима
+# стека на блокираната нишка, а след отблокирането се логва колко е траело, кои handler-и
+# са били активни и къде е стоял кодът.
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))  # редове във всяка таблица на отчета
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0"))  # напр. 0.5
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_STACK_DEPTH = 12
+
+_ACTIVE_HANDLERS: Dict[int, Tuple[str, float]] = {}  # жетон -> (handler, начало)
+_HANDLER_TOKENS = itertools.count()
+
+def active_handlers() -> List[str]:
+    now = perf_counter()
+    return [f"{name} ({(now - started) * 1000:.0f} ms)"
+            for name, started in sorted(list(_ACTIVE_HANDLERS.values()), key=lambda x: x[1])]
+
+class LoopLagMonitor:
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_LAG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = 0
+        self._beat_at = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._stall: Optional[Tuple[List[str], List[str]]] = None  # (handler-и, стек), снети от пазача
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.threshold <= 0 or self._handle is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat_at = monotonic()
+        self._handle = self._loop.call_later(self.interval, self._beat)
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _beat(self) -> None:
+        now = monotonic()
+        lag = max(0.0, now - self._beat_at - self.interval)
+        if METRICS_ENABLED:
+            METRICS.observe("bot_loop_lag_seconds", lag)
+        if lag >= self.threshold:
+            self.stalls += 1
+            self.max_lag = max(self.max_lag, lag)
+            handlers, stack = self._stall or (active_handlers(), [])
+            logger.warning("Event loop blocked for %.0f ms; active handlers: %s%s", lag * 1000,
+                           ", ".join(handlers) or "-", "\n" + "".join(stack) if stack else "")
+        self._stall = None
+        self._beat_at = now
+        self._handle = self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            if self._stall is None and monotonic() - self._beat_at - self.interval >= self.threshold:
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = traceback.format_stack(frame)[-LOOP_LAG_STACK_DEPTH:] if frame is not None else []
+                self._stall = (active_handlers(), stack)
+
+LOOP_MONITOR = LoopLagMonitor()
+
+async def profile_loop(seconds: float) -> str:
+    """cProfile на нишката на event loop-а за seconds сек. Връща отчета като текст."""
+    profiler = cProfile.Profile()
+    stalls = LOOP_MONITOR.stalls
+    API.timings = {}
+    started = perf_counter()
+    profiler.enable()  # ValueError, ако вече тече друг профил
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        timings, API.timings = API.timings, None
+    wall = perf_counter() - started
+
+    out = io.StringIO()
+    out.write(f"Профил на event loop-а: {wall:.1f} s, {datetime.now(TIMEZONE):%d.%m.%Y %H:%M:%S}\n")
+    if LOOP_LAG_THRESHOLD > 0:
+        out.write(f"Блокирания над {LOOP_LAG_THRESHOLD:g} s: {LOOP_MONITOR.stalls - stalls}\n")
+    else:
+        out.write("Блокирания: наблюдателят е изключен (LOOP_LAG_THRESHOLD=0)\n")
+    out.write("select/poll в таблиците = времето, в което event loop-ът е бездействал\n\n")
+    out.write("Bot API (реално време, вкл. чакането на отговор):\n")
+    for method, (count, total) in sorted(timings.items(), key=lambda x: -x[1][1]):
+        out.write(f"  {method:<24} n={count:<6} общо={total:8.3f} s  средно={total / count * 1000:7.1f} ms\n")
+    if not timings:
+        out.write("  няма извиквания\n")
+    for key, title in (("tottime", "собствено време"), ("cumulative", "общо време (вкл. извиканите)")):
+        out.write(f"\n=== Топ {PROFILE_TOP} по {title} ===\n")
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats(key).print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+# ------------------ СЪХРАНЕНИЕ ------------------
+# Хранилището е сменяемо (STORAGE=json|sqlite); помощните функции по-долу работят
+# само през STORE и не знаят кой бекенд стои отдолу.
+#
+# json: състоянието се зарежда веднъж при старт и живее в паметта. Всяка промяна е кратък
+# запис в журнал само за добавяне; фонов поток дописва натрупаните записи наведнъж
+# (write-behind) – най-късно след FLUSH_INTERVAL секунди или след FLUSH_MAX_PENDING промени.
+# FLUSH_INTERVAL=0 → запис веднага. Журналът периодично се сгъва в компактна снимка.
+#
+# sqlite: всеки артикул е ред (topic, day, pos, text); добавяне/редакция струва O(1) заявки,
+# независимо от историята. При първо стартиране order_data.json се импортира автоматично.
+STORAGE = os.getenv("STORAGE", "json").strip().lower()
+DB_FILE = os.getenv("DB_FILE", "order_data.db")
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2.0"))  # прозорец на издръжливост (сек.)
+FLUSH_MAX_PENDING = int(os.getenv("FLUSH_MAX_PENDING", "100"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"
+
+def topic_key(chat_id: int, thread_id: Optional[int]) -> str:
+    return f"{chat_id}{SEP}{thread_id if thread_id is not None else 0}"
+
+def _empty_data() -> Dict:
+    return {"enabled_topics": [], "lists": {}, "list_msgs": {}}
+
+def _page_ids(value) -> List[int]:
+    """list_msgs пази списък от id-та по страници; стари данни имат едно число."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [int(m) for m in value]
+    return [int(value)]
+
+def _normalize_legacy(data: Dict) -> Dict:
+    """Привежда стар order_data.json към текущия формат (за импорт)."""
+    data.setdefault("enabled_topics", [])
+    data.setdefault("lists", {})
+    data.setdefault("list_msgs", {})
+    # Ключове само с chat_id (отпреди Topics) → Topic 0 на същия чат
+    for section in ("lists", "list_msgs"):
+        for key in [k for k in data[section] if SEP not in k]:
+            old = data[section].pop(key) or {}
+            target = data[section].setdefault(f"{key}{SEP}0", {})
+            for day, value in old.items():
+                if section == "lists":
+                    target[day] = list(value) + target.get(day, [])
+                else:
+                    target.setdefault(day, value)
+    # "chats" = активирани чатове отпреди Topics; пренасяме ги като Topic 0,
+    # но само ако чатът още няма нито един активиран Topic.
+    enabled = data["enabled_topics"]
+    for chat_id in data.pop("chats", None) or []:
+        prefix = f"{chat_id}{SEP}"
+        if not any(k.startswith(prefix) for k in enabled):
+            enabled.append(f"{chat_id}{SEP}0")
+    return data
+
+class JsonStorage:
+    """Снимка (order_data.json) + журнал само за добавяне (order_data.json.journal).
+
+    Всяка промяна е един ред в журнала; при старт се зарежда снимката и се изпълнява
+    остатъкът от журнала. Когато журналът порасне над JOURNAL_COMPACT_BYTES, се сгъва
+    в нова компактна снимка и се изпразва.
+    """
+
+    def __init__(self, path: str, journal_path: Optional[str] = None):
+        self.path = path
+        self.journal_path = journal_path or path + ".journal"
+        self._state: Optional[Dict] = None
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._seq = 0  # последен номер на запис в журнала
+        self._buffer: List[str] = []  # записи, още незаписани на диск
+        self._first_change_at = 0.0
+        self._journal_bytes = 0
+        self.bytes_written = 0  # общо записани байтове (журнал + снимки)
+        self._flusher: Optional[threading.Thread] = None
+        self._stopping = False
+
+    # --- зареждане ---
+    def _read_snapshot(self) -> Dict:
+        if not os.path.exists(self.path):
+            return _empty_data()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                data.setdefault("enabled_topics", [])
+                data.setdefault("lists", {})
+                data.setdefault("list_msgs", {})
+                return data
+        except Exception:
+            logger.exception("Cannot read %s, starting empty", self.path)
+            return _empty_data()
+
+    def _replay_journal(self, state: Dict, snapshot_seq: int) -> None:
+        if not os.path.exists(self.journal_path):
+            return
+        good_until = 0
+        replayed = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break  # недописан последен запис (срив по време на запис)
+                if not line.endswith(b"\n"):
+                    break
+                good_until += len(line)
+                seq = int(rec.get("seq", 0))
+                if seq > snapshot_seq:
+                    _apply_record(state, rec)
+                    replayed += 1
+                self._seq = max(self._seq, seq)
+        size = os.path.getsize(self.journal_path)
+        if good_until < size:
+            logger.warning("Dropping %d bytes of torn journal tail in %s", size - good_until, self.journal_path)
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_until)
+        self._journal_bytes = good_until
+        if replayed:
+            logger.info("Replayed %d journal records from %s", replayed, self.journal_path)
+
+    def data(self) -> Dict:
+        with self._lock:
+            if self._state is None:
+                started = perf_counter()
+                state = self._read_snapshot()
+                self._seq = int(state.pop("journal_seq", 0) or 0)
+                self._replay_journal(state, self._seq)
+                self._state = state
+                if METRICS_ENABLED:
+                    size = sum(os.path.getsize(p) for p in (self.path, self.journal_path) if os.path.exists(p))
+                    _storage_metric("load", started, size)
+            return self._state
+
+    # --- запис ---
+    def _log(self, rec: Dict) -> None:
+        # Извиква се с взет self._lock: прилага операцията и я буферира за журнала
+        _apply_record(self.data(), rec)
+        self._seq += 1
+        rec["seq"] = self._seq
+        if not self._buffer:
+            self._first_change_at = monotonic()
+        self._buffer.append(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if FLUSH_INTERVAL <= 0 or self._flusher is None:
+            self._write()
+        elif len(self._buffer) == 1 or len(self._buffer) >= FLUSH_MAX_PENDING:
+            self._cond.notify()
+
+    def _write(self) -> None:
+        # Извиква се с взет self._lock
+        if not self._buffer:
+            return
+        self._append_buffer()
+        if self._journal_bytes >= JOURNAL_COMPACT_BYTES:
+            self.compact()
+
+    def _append_buffer(self) -> None:
+        # Едно последователно дописване в журнала за всички натрупани записи
+        if not self._buffer:
+            return
+        started = perf_counter()
+        chunk = "".join(self._buffer).encode("utf-8")
+        self._buffer = []
+        with open(self.journal_path, "ab") as f:
+            f.write(chunk)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        self._journal_bytes += len(chunk)
+        self.bytes_written += len(chunk)
+        if METRICS_ENABLED:
+            _storage_metric("journal", started, len(chunk))
+
+    def compact(self) -> None:
+        """Сгъва журнала в нова снимка (атомарно) и го изпразва."""
+        with self._lock:
+            self._append_buffer()
+            started = perf_counter()
+            snapshot = dict(self.data())
+            snapshot["journal_seq"] = self._seq
+            payload = json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(payload)
+                f.flush()
+                if JOURNAL_FSYNC:
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.bytes_written += len(payload)
+            # Срив между replace и truncate е безопасен: записите с seq <= journal_seq се прескачат
+            with open(self.journal_path, "wb"):
+                pass
+            self._journal_bytes = 0
+            if METRICS_ENABLED:
+                _storage_metric("snapshot", started, len(payload))
+
+    def _flusher_loop(self) -> None:
+        with self._cond:
+            while True:
+                while not self._buffer and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    break
+                # Събираме промени, докато изтече прозорецът или се натрупат достатъчно
+                while not self._stopping and len(self._buffer) < FLUSH_MAX_PENDING:
+                    left = self._first_change_at + FLUSH_INTERVAL - monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                try:
+                    self._write()
+                except Exception:
+                    logger.exception("Failed to write %s", self.journal_path)
+
+    def load(self) -> None:
+        self.data()
+
+    def start(self) -> None:
+        # Без зареждане: data() се вика при първата нужда (или от warm_up във фонов поток)
+        if self._flusher is not None or FLUSH_INTERVAL <= 0:
+            return
+        self._stopping = False
+        self._flusher = threading.Thread(target=self._flusher_loop, name="state-flusher", daemon=True)
+        self._flusher.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._write()
+
+    def close(self) -> None:
+        """Спира фоновия запис и записва всичко натрупано (при изключване)."""
+        t = self._flusher
+        if t is not None:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            t.join()
+            self._flusher = None
+        with self._lock:
+            if self._state is not None and (self._buffer or self._journal_bytes):
+                self.compact()
+
+    # --- операции ---
+    def get_items(self, k: str, day: str) -> List[str]:
+        # Връщаме копие – викащите често го променят преди set_items
+        with self._lock:
+            return list(self.data()["lists"].get(k, {}).get(day, []))
+
+    def set_items(self, k: str, day: str, items: List[str]) -> None:
+        with self._lock:
+            if items:
+                self._log({"op": "set", "k": k, "d": day, "items": list(items)})
+            else:
+                self._log({"op": "clear", "k": k, "d": day})
+
+    def append_items(self, k: str, day: str, items: List[str]) -> None:
+        with self._lock:
+            self._log({"op": "add", "k": k, "d": day, "items": list(items)})
+
+    def get_list_msgs(self, k: str, day: str) -> List[int]:
+        with self._lock:
+            return _page_ids(self.data()["list_msgs"].get(k, {}).get(day))
+
+    def set_list_msgs(self, k: str, day: str, message_ids: List[int]) -> None:
+        with self._lock:
+            self._log({"op": "msg", "k": k, "d": day, "ids": [int(m) for m in message_ids]})
+
+    def list_msgs_for_day(self, day: str) -> Dict[str, List[int]]:
+        out: Dict[str, List[int]] = {}
+        with self._lock:
+            for k, days in self.data()["list_msgs"].items():
+                ids = _page_ids(days.get(day))
+                if ids:
+                    out[k] = ids
+        return out
+
+    def enabled_topics(self) -> List[str]:
+        with self._lock:
+            return list(self.data()["enabled_topics"])
+
+    def set_enabled(self, k: str, enabled: bool) -> bool:
+        with self._lock:
+            if enabled == (k in self.data()["enabled_topics"]):
+                return False
+            self._log({"op": "enable" if enabled else "disable", "k": k})
+            return True
+
+    def clear_many(self, keys: List[str], day: str) -> None:
+        with self._lock:
+            self._log({"op": "clear_many", "ks": list(keys), "d": day})
+
+    def days_before(self, cutoff: str) -> Dict[str, Dict[str, List[str]]]:
+        with self._lock:
+            return {
+                k: {d: list(items) for d, items in days.items() if d < cutoff}
+                for k, days in self.data()["lists"].items()
+                if any(d < cutoff for d in days)
+            }
+
+    def iter_history(self, start: str, end: str, chat_id: Optional[int] = None,
+                     k: Optional[str] = None) -> Iterator[Tuple[str, str, int, str]]:
+        """(ден, topic_key, позиция от 1, артикул) за дните в [start, end], по ден и Topic.
+        Заключването се взима за всеки ден поотделно, не за целия обход. Не е поточно спрямо
+        диска: data() държи цялата снимка + журнал в паметта."""
+        with self._lock:
+            docs = sorted((day, key) for key, days in self.data()["lists"].items()
+                          if _topic_matches(key, chat_id, k) for day in days if start <= day <= end)
+        for day, key in docs:
+            for pos, text in enumerate(self.get_items(key, day), 1):
+                yield day, key, pos, text
+
+    def drop_days_before(self, cutoff: str) -> Tuple[int, int]:
+        """Премахва дните преди cutoff (списъци и list_msgs). Връща (дни, list_msgs)."""
+        with self._lock:
+            data = self.data()
+            days = sum(1 for per in data["lists"].values() for d in per if d < cutoff)
+            msgs = sum(1 for per in data["list_msgs"].values() for d in per if d < cutoff)
+            if days or msgs:
+                self._log({"op": "prune", "before": cutoff})
+            return days, msgs
+
+    def disk_size(self) -> int:
+        with self._lock:
+            return sum(os.path.getsize(p) for p in (self.path, self.journal_path) if os.path.exists(p))
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            return copy.deepcopy(self.data().get("meta", {}).get(key, default))
+
+    def set_meta(self, key: str, value) -> None:
+        with self._lock:
+            self._log({"op": "meta", "key": key, "value": value})
+
+    # --- цялото съдържание (за преразпределяне между шардове) ---
+    def export_data(self) -> Dict:
+        with self._lock:
+            data = copy.deepcopy(self.data())
+        data.setdefault("meta", {})
+        return data
+
+    def import_data(self, data: Dict, source: str = "") -> int:
+        """Слива JSON структура в състоянието и записва нова снимка. Връща броя артикули."""
+        data = _normalize_legacy(json.loads(json.dumps(data)))
+        with self._lock:
+            _merge_data(self.data(), data)
+            self.compact()
+        return sum(len(items) for days in data["lists"].values() for items in days.values())
+
+def _apply_record(state: Dict, rec: Dict) -> None:
+    """Прилага един запис от журнала върху състоянието (същият код при работа и при replay)."""
+    op = rec.get("op")
+    k = rec.get("k")
+    if op == "add":
+        state["lists"].setdefault(k, {}).setdefault(rec["d"], []).extend(rec["items"])
+    elif op == "set":
+        state["lists"].setdefault(k, {})[rec["d"]] = list(rec["items"])
+    elif op == "clear":
+        state["lists"].setdefault(k, {})[rec["d"]] = []
+    elif op == "clear_many":
+        for key in rec["ks"]:
+            state["lists"].setdefault(key, {})[rec["d"]] = []
+    elif op == "msg":
+        # Стари записи носят едно "id", новите – "ids" по страници
+        state["list_msgs"].setdefault(k, {})[rec["d"]] = _page_ids(rec["ids"] if "ids" in rec else rec["id"])
+    elif op == "enable":
+        if k not in state["enabled_topics"]:
+            state["enabled_topics"].append(k)
+    elif op == "disable":
+        if k in state["enabled_topics"]:
+            state["enabled_topics"].remove(k)
+    elif op == "meta":
+        state.setdefault("meta", {})[rec["key"]] = rec["value"]
+    elif op == "prune":
+        for section in ("lists", "list_msgs"):
+            for key in list(state[section]):
+                per = state[section][key]
+                for day in [d for d in per if d < rec["before"]]:
+                    del per[day]
+                if not per:
+                    del state[section][key]
+    else:
+        logger.warning("Unknown journal op %r", op)
+
+class SqliteStorage:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS items (
+        topic TEXT NOT NULL,
+        day   TEXT NOT NULL,
+        pos   INTEGER NOT NULL,
+        text  TEXT NOT NULL,
+        PRIMARY KEY (topic, day, pos)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS items_day ON items(day, topic);
+    CREATE TABLE IF NOT EXISTS list_pages (
+        topic      TEXT NOT NULL,
+        day        TEXT NOT NULL,
+        page       INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (topic, day, page)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS enabled_topics (
+        seq   INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        # list_msgs (едно съобщение на ден) → list_pages (страница 0)
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'list_msgs'").fetchone():
+            with self._tx() as db:
+                db.execute(
+                    "INSERT OR IGNORE INTO list_pages (topic, day, page, message_id) "
+                    "SELECT topic, day, 0, message_id FROM list_msgs"
+                )
+                db.execute("DROP TABLE list_msgs")
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE ... COMMIT/ROLLBACK като една транзакция
+        with self._lock:
+            started = perf_counter()
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            if METRICS_ENABLED:
+                _storage_metric("tx", started)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT (SELECT COUNT(*) FROM items) + (SELECT COUNT(*) FROM enabled_topics)"
+                " + (SELECT COUNT(*) FROM meta)"
+            ).fetchone()
+            return row[0] == 0
+
+    def import_data(self, data: Dict, source: str = "") -> int:
+        """Импортира JSON структура (вкл. стария формат) с една транзакция. Връща броя артикули."""
+        data = _normalize_legacy(json.loads(json.dumps(data)))
+        count = 0
+        with self._tx() as db:
+            for k, days in data["lists"].items():
+                for day, items in (days or {}).items():
+                    db.execute("DELETE FROM items WHERE topic = ? AND day = ?", (k, day))
+                    db.executemany(
+                        "INSERT INTO items (topic, day, pos, text) VALUES (?, ?, ?, ?)",
+                        [(k, day, i, str(t)) for i, t in enumerate(items or [])],
+                    )
+                    count += len(items or [])
+            for k, days in data["list_msgs"].items():
+                for day, value in (days or {}).items():
+                    db.executemany(
+                        "INSERT OR REPLACE INTO list_pages (topic, day, page, message_id) VALUES (?, ?, ?, ?)",
+                        [(k, day, page, msg_id) for page, msg_id in enumerate(_page_ids(value))],
+                    )
+            for k in data["enabled_topics"]:
+                db.execute("INSERT OR IGNORE INTO enabled_topics (topic) VALUES (?)", (k,))
+            meta = dict(data.get("meta") or {})
+            meta["imported_from"] = source or "-"
+            db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in meta.items()],
+            )
+        return count
+
+    def load(self) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def get_items(self, k: str, day: str) -> List[str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT text FROM items WHERE topic = ? AND day = ? ORDER BY pos", (k, day)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def set_items(self, k: str, day: str, items: List[str]) -> None:
+        with self._tx() as db:
+            db.execute("DELETE FROM items WHERE topic = ? AND day = ?", (k, day))
+            db.executemany(
+                "INSERT INTO items (topic, day, pos, text) VALUES (?, ?, ?, ?)",
+                [(k, day, i, t) for i, t in enumerate(items)],
+            )
+
+    def append_items(self, k: str, day: str, items: List[str]) -> None:
+        with self._tx() as db:
+            row = db.execute(
+                "SELECT COALESCE(MAX(pos) + 1, 0) FROM items WHERE topic = ? AND day = ?", (k, day)
+            ).fetchone()
+            db.executemany(
+                "INSERT INTO items (topic, day, pos, text) VALUES (?, ?, ?, ?)",
+                [(k, day, row[0] + i, t) for i, t in enumerate(items)],
+            )
+
+    def get_list_msgs(self, k: str, day: str) -> List[int]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT message_id FROM list_pages WHERE topic = ? AND day = ? ORDER BY page", (k, day)
+            ).fetchall()
+        return [int(r[0]) for r in rows]
+
+    def set_list_msgs(self, k: str, day: str, message_ids: List[int]) -> None:
+        with self._tx() as db:
+            db.execute("DELETE FROM list_pages WHERE topic = ? AND day = ?", (k, day))
+            db.executemany(
+                "INSERT INTO list_pages (topic, day, page, message_id) VALUES (?, ?, ?, ?)",
+                [(k, day, page, int(m)) for page, m in enumerate(message_ids)],
+            )
+
+    def list_msgs_for_day(self, day: str) -> Dict[str, List[int]]:
+        out: Dict[str, List[int]] = {}
+        with self._lock:
+            for k, msg_id in self._db.execute(
+                "SELECT topic, message_id FROM list_pages WHERE day = ? ORDER BY topic, page", (day,)
+            ):
+                out.setdefault(k, []).append(int(msg_id))
+        return out
+
+    def enabled_topics(self) -> List[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT topic FROM enabled_topics ORDER BY seq").fetchall()
+        return [r[0] for r in rows]
+
+    def set_enabled(self, k: str, enabled: bool) -> bool:
+        with self._lock:
+            if enabled:
+                cur = self._db.execute("INSERT OR IGNORE INTO enabled_topics (topic) VALUES (?)", (k,))
+            else:
+                cur = self._db.execute("DELETE FROM enabled_topics WHERE topic = ?", (k,))
+            return cur.rowcount > 0
+
+    def clear_many(self, keys: List[str], day: str) -> None:
+        with self._tx() as db:
+            db.executemany("DELETE FROM items WHERE topic = ? AND day = ?", [(k, day) for k in keys])
+
+    def days_before(self, cutoff: str) -> Dict[str, Dict[str, List[str]]]:
+        out: Dict[str, Dict[str, List[str]]] = {}
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT topic, day, text FROM items WHERE day < ? ORDER BY topic, day, pos", (cutoff,)
+            )
+            for k, day, text in rows:
+                out.setdefault(k, {}).setdefault(day, []).append(text)
+        return out
+
+    def iter_history(self, start: str, end: str, chat_id: Optional[int] = None,
+                     k: Optional[str] = None) -> Iterator[Tuple[str, str, int, str]]:
+        sql = "SELECT day, topic, pos, text FROM items WHERE day BETWEEN ? AND ?"
+        params: List = [start, end]
+        if k is not None:
+            sql += " AND topic = ?"
+            params.append(k)
+        elif chat_id is not None:
+            sql += " AND topic LIKE ?"
+            params.append(f"{chat_id}{SEP}%")
+        # Отделна връзка: дългият обход чете от собствена снимка (WAL) и не държи self._lock
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            for day, topic, pos, text in db.execute(sql + " ORDER BY day, topic, pos", params):
+                yield day, topic, pos + 1, text
+        finally:
+            db.close()
+
+    def drop_days_before(self, cutoff: str) -> Tuple[int, int]:
+        with self._tx() as db:
+            days = db.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT topic, day FROM items WHERE day < ?)", (cutoff,)
+            ).fetchone()[0]
+            db.execute("DELETE FROM items WHERE day < ?", (cutoff,))
+            msgs = db.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT topic, day FROM list_pages WHERE day < ?)", (cutoff,)
+            ).fetchone()[0]
+            db.execute("DELETE FROM list_pages WHERE day < ?", (cutoff,))
+        return days, msgs
+
+    def disk_size(self) -> int:
+        with self._lock:
+            pages, page_size = (
+                self._db.execute("PRAGMA page_count").fetchone()[0],
+                self._db.execute("PRAGMA page_size").fetchone()[0],
+            )
+        return pages * page_size
+
+    def compact(self) -> None:
+        with self._lock:
+            self._db.execute("VACUUM")
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
+    def export_data(self) -> Dict:
+        """Цялото съдържание в JSON структурата на JsonStorage."""
+        data = _empty_data()
+        with self._lock:
+            for k, day, text in self._db.execute("SELECT topic, day, text FROM items ORDER BY topic, day, pos"):
+                data["lists"].setdefault(k, {}).setdefault(day, []).append(text)
+            for k, day, msg_id in self._db.execute(
+                "SELECT topic, day, message_id FROM list_pages ORDER BY topic, day, page"
+            ):
+                data["list_msgs"].setdefault(k, {}).setdefault(day, []).append(msg_id)
+            data["enabled_topics"] = [r[0] for r in self._db.execute("SELECT topic FROM enabled_topics ORDER BY seq")]
+            data["meta"] = {key: json.loads(value) for key, value in self._db.execute("SELECT key, value FROM meta")}
+        return data
+
+def _merge_data(into: Dict, data: Dict) -> None:
+    """Добавя data към into (списъци и list_msgs по ден, активни Topics, meta)."""
+    for section in ("lists", "list_msgs"):
+        for k, days in data.get(section, {}).items():
+            into.setdefault(section, {}).setdefault(k, {}).update(days)
+    enabled = into.setdefault("enabled_topics", [])
+    enabled.extend(k for k in data.get("enabled_topics", []) if k not in enabled)
+    meta = into.setdefault("meta", {})
+    for key, value in (data.get("meta") or {}).items():
+        if isinstance(value, dict) and isinstance(meta.get(key), dict):
+            meta[key].update(value)
+        else:
+            meta[key] = value
+
+def import_json_file(path: str, storage: "SqliteStorage") -> int:
+    # През JsonStorage, а не json.load: след непочистено спиране последните промени са само
+    # в журнала (path.journal). Без close() – източникът не се пренаписва.
+    source = JsonStorage(path)
+    if not (os.path.exists(source.path) or os.path.exists(source.journal_path)):
+        raise FileNotFoundError(path)
+    data = source.export_data()
+    return storage.import_data(data, source=os.path.abspath(path))
+
+def open_storage(data_file: str = DATA_FILE, db_file: str = DB_FILE):
+    if STORAGE == "sqlite":
+        storage = SqliteStorage(db_file)
+        if storage.is_empty() and (os.path.exists(data_file) or os.path.exists(data_file + ".journal")):
+            n = import_json_file(data_file, storage)
+            logger.info("Imported %d items from %s into %s", n, data_file, db_file)
+        return storage
+    if STORAGE != "json":
+        raise RuntimeError(f"Непознат STORAGE={STORAGE!r} (очаква се json или sqlite).")
+    return JsonStorage(data_file)
+
+_STORE = None
+
+def get_storage():
+    global _STORE
+    if _STORE is None:
+        _STORE = open_storage()
+    return _STORE
+
+def start_storage() -> None:
+    get_storage().start()
+    atexit.register(close_storage)
+
+def close_storage() -> None:
+    global _STORE
+    if _STORE is not None:
+        _STORE.close()
+        _STORE = None
+
+def today_key() -> str:
+    return datetime.now(TIMEZONE).strftime("%Y-%m-%d")
+
+def render_list_pages(items: List[str], limit: Optional[int] = None) -> List[str]:
+    """Разделя списъка на страници до limit знака. Пълни страниците отпред назад, така че
+    добавяне в края променя само последната страница (или отваря нова)."""
+    limit = limit or LIST_PAGE_LIMIT
+    pages: List[List[str]] = [[]]
+    size = len(_page_header(1))
+    for item in items:
+        line = "• " + item
+        max_line = limit - len(_page_header(len(pages) + 1)) - 1
+        if len(line) > max_line:
+            line = line[:max_line - 1] + "…"
+        if pages[-1] and size + 1 + len(line) > limit:
+            pages.append([])
+            size = len(_page_header(len(pages)))
+        pages[-1].append(line)
+        size += 1 + len(line)
+    return ["\n".join([_page_header(n)] + lines) for n, lines in enumerate(pages, 1)]
+
+def _page_header(n: int) -> str:
+    return "Днешният списък:" if n == 1 else f"Днешният списък (стр. {n}):"
+
+# Версия на днешния списък по Topic: сменя се при всяка промяна през помощниците долу.
+# Уизардът /edit по нея разбира, че снимката му вече не отговаря на списъка.
+_LIST_VERSIONS: Dict[str, int] = {}
+_LIST_VERSION_SEQ = itertools.count(int(time_now()))
+
+def list_version(k: str) -> int:
+    if k not in _LIST_VERSIONS:
+        _LIST_VERSIONS[k] = next(_LIST_VERSION_SEQ)
+    return _LIST_VERSIONS[k]
+
+def bump_list_version(k: str) -> None:
+    _LIST_VERSIONS[k] = next(_LIST_VERSION_SEQ)
+
+def append_item(k: str, item: str) -> None:
+    item = item.strip()
+    if item:
+        get_storage().append_items(k, today_key(), [item])
+        bump_list_version(k)
+        SUMMARY.add(k, [item])
+        SEARCH.add(k, [item])
+
+def append_items(k: str, items: List[str]) -> int:
+    """Добавя много артикула с един запис в хранилището. Връща броя добавени."""
+    items = [x.strip() for x in items if x.strip()]
+    if items:
+        get_storage().append_items(k, today_key(), items)
+        bump_list_version(k)
+        SUMMARY.add(k, items)
+        SEARCH.add(k, items)
+    return len(items)
+
+def clear_today(k: str) -> None:
+    get_storage().set_items(k, today_key(), [])
+    bump_list_version(k)
+    SUMMARY.set(k, [])
+    SEARCH.set(k, [])
+
+def get_today(k: str) -> List[str]:
+    return get_storage().get_items(k, today_key())
+
+def set_today_list(k: str, items: List[str]) -> None:
+    get_storage().set_items(k, today_key(), items)
+    bump_list_version(k)
+    SUMMARY.set(k, items)
+    SEARCH.set(k, items)
+
+def set_list_message_ids(k: str, message_ids: List[int]) -> None:
+    get_storage().set_list_msgs(k, today_key(), message_ids)
+    STATE.set_list_msgs(k, message_ids)
+    # Кешът пази само текущите страници – иначе расте с вчерашните id-та всеки ден
+    cache = _LIST_PAGE_TEXT.get(k)
+    if cache:
+        keep = set(message_ids)
+        for msg_id in [m for m in cache if m not in keep]:
+            del cache[msg_id]
+
+def get_list_message_ids(k: str) -> List[int]:
+    return STATE.list_msgs(k)
+
+def parse_topic_key(k: str) -> Tuple[int, Optional[int]]:
+    chat_id, thread = k.split(SEP, 1)
+    return int(chat_id), (int(thread) or None)
+
+def get_topic_time(k: str) -> Tuple[int, int]:
+    """Час за дневното съобщение на Topic-а (по подразбиране DAILY_HOUR:00)."""
+    value = get_storage().get_meta("topic_times", {}).get(k)
+    if value:
+        hour, minute = value.split(":")
+        return int(hour), int(minute)
+    return DAILY_HOUR, 0
+
+def set_topic_time(k: str, hour_minute: Optional[Tuple[int, int]]) -> None:
+    times = get_storage().get_meta("topic_times", {})
+    if hour_minute is None:
+        times.pop(k, None)
+    else:
+        times[k] = "%02d:%02d" % hour_minute
+    get_storage().set_meta("topic_times", times)
+
+def is_topic_enabled(k: str) -> bool:
+    return k in STATE.enabled_topics()
+
+def get_enabled_topics() -> List[str]:
+    return list(STATE.enabled_topics())
+
+def enable_topic(chat_id: int, thread_id: Optional[int]) -> None:
+    k = topic_key(chat_id, thread_id)
+    storage = get_storage()
+    storage.set_enabled(k, True)
+    STATE.set_enabled(k, True)
+    SUMMARY.enable(k)
+    now = datetime.now(TIMEZONE)
+    hour, minute = get_topic_time(k)
+    if now.hour * 60 + now.minute >= hour * 60 + minute:
+        # Часът за днес вече е минал: без това следващото обикаляне (в рамките на
+        # DAILY_CATCHUP_MINUTES) би изчистило току-що добавените елементи.
+        day = now.strftime("%Y-%m-%d")
+        done = {t: d for t, d in storage.get_meta("daily_done", {}).items() if d == day}
+        done[k] = day
+        storage.set_meta("daily_done", done)
+
+def disable_topic(chat_id: int, thread_id: Optional[int]) -> None:
+    k = topic_key(chat_id, thread_id)
+    get_storage().set_enabled(k, False)
+    STATE.set_enabled(k, False)
+    SUMMARY.disable(k)
+    _LIST_PAGE_TEXT.pop(k, None)
+
+# ------------------ СТАРТОВО СЪСТОЯНИЕ ------------------
+# STATE_FILE е малък файл с това, което ботът ползва веднага след рестарт: активните Topics,
+# днешните list-съобщения, отложените изтривания и започнатите /edit уизарди. Размерът му
+# зависи от броя Topics, не от историята, затова се чете за милисекунди; пълното хранилище
+# (при JSON) се зарежда после във фонов поток (warm_up), докато ботът вече приема ъпдейти.
+# Файлът се презаписва атомарно STATE_SAVE_DELAY сек. след промяна (няколко промени → един
+# запис). Активните Topics и list-съобщенията се пишат първо в хранилището, което остава
+# източникът на истината: след зареждането му снимката се сверява с него, така че срив
+# между двата записа не губи нищо. Уизардите и изтриванията живеят само тук.
+STATE_FILE = os.getenv("STATE_FILE", "bot_state.json")
+STATE_SAVE_DELAY = float(os.getenv("STATE_SAVE_DELAY", "0.5"))
+
+def _empty_state() -> Dict:
+    return {"day": today_key(), "enabled_topics": [], "list_msgs": {}, "pending_deletes": {}, "wizards": {}}
+
+class StartupState:
+    def __init__(self, path: str):
+        self.path = path
+        self._data: Optional[Dict] = None
+        self.synced = False  # сверено с вече зареденото хранилище
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+
+    def load(self) -> None:
+        started = perf_counter()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            source = self.path
+        except FileNotFoundError:
+            data = None
+        except ValueError:
+            logger.exception("Cannot read %s, rebuilding it from storage", self.path)
+            data = None
+        if data is None:
+            data = self._rebuild()
+            source = "storage"
+        else:
+            self._data = data
+            self.synced = False
+        self._roll_day()
+        # Уизард от вчера така или иначе е невалиден (_current_items)
+        day = self._data["day"]
+        self._data["wizards"] = {key: w for key, w in self._data.get("wizards", {}).items() if w.get("day") == day}
+        logger.info("Startup state from %s: %d topics, %d wizards, %d chats with pending deletes in %.1f ms",
+                    source, len(data["enabled_topics"]), len(data["wizards"]), len(data["pending_deletes"]),
+                    (perf_counter() - started) * 1000)
+
+    @property
+    def data(self) -> Dict:
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def _roll_day(self) -> None:
+        day = today_key()
+        if self._data["day"] != day:
+            self._data.update(day=day, list_msgs={})
+
+    def _rebuild(self) -> Dict:
+        # Първи старт (или след преразпределяне на шардовете): всичко идва от хранилището.
+        # По-старите версии (и rebalance) пазят отложените изтривания в meta на хранилището.
+        self._data = _empty_state()
+        self.sync()
+        storage = get_storage()
+        legacy = storage.get_meta("pending_deletes")
+        if legacy:
+            self._data["pending_deletes"] = legacy
+            storage.set_meta("pending_deletes", {})
+        self.save()
+        return self._data
+
+    def sync(self) -> None:
+        """Активните Topics и днешните list-съобщения – от хранилището (то е по-новото)."""
+        storage = get_storage()
+        data = self.data
+        data["day"] = today_key()
+        enabled = storage.enabled_topics()
+        msgs = storage.list_msgs_for_day(data["day"])
+        if enabled != data["enabled_topics"] or msgs != data["list_msgs"]:
+            if data["enabled_topics"] or data["list_msgs"]:
+                logger.warning("Startup state was behind storage, resyncing %s", self.path)
+            data.update(enabled_topics=enabled, list_msgs=msgs)
+            self.mark()
+        self.synced = True
+
+    # --- запис ---
+    def mark(self) -> None:
+        """Отбелязва промяна; записът става след STATE_SAVE_DELAY (веднага, ако няма event loop)."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(STATE_SAVE_DELAY, self.save)
+
+    def save(self) -> None:
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._data is None:
+            return
+        payload = json.dumps(self._data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self) -> None:
+        if self._save_handle is not None:
+            self.save()
+        self._data = None
+        self.synced = False
+
+    # --- съдържание ---
+    def enabled_topics(self) -> List[str]:
+        return self.data["enabled_topics"]
+
+    def set_enabled(self, k: str, enabled: bool) -> None:
+        topics = self.data["enabled_topics"]
+        if enabled and k not in topics:
+            topics.append(k)
+        elif not enabled and k in topics:
+            topics.remove(k)
+        else:
+            return
+        self.mark()
+
+    def list_msgs(self, k: str) -> List[int]:
+        self._roll_day()
+        return list(self.data["list_msgs"].get(k, []))
+
+    def set_list_msgs(self, k: str, message_ids: List[int]) -> None:
+        self._roll_day()
+        if message_ids:
+            self.data["list_msgs"][k] = [int(m) for m in message_ids]
+        else:
+            self.data["list_msgs"].pop(k, None)
+        self.mark()
+
+    def pending_deletes(self) -> Dict[str, List]:
+        return self.data["pending_deletes"]
+
+    def set_pending_deletes(self, value: Dict[str, List]) -> None:
+        self.data["pending_deletes"] = value
+        self.mark()
+
+    def wizard(self, user_id: int, k: str) -> Optional[Dict]:
+        return self.data["wizards"].get(f"{user_id}:{k}")
+
+    def set_wizard(self, user_id: int, k: str, state: Dict) -> Dict:
+        # По-късни промени в самия state се записват с mark()
+        self.data["wizards"][f"{user_id}:{k}"] = state
+        self.mark()
+        return state
+
+    def drop_wizard(self, user_id: int, k: str) -> None:
+        if self.data["wizards"].pop(f"{user_id}:{k}", None) is not None:
+            self.mark()
+
+STATE = StartupState(STATE_FILE)
+_WARM_UP: Optional[asyncio.Task] = None
+
+async def _warm_up() -> None:
+    started = perf_counter()
+    try:
+        await asyncio.to_thread(get_storage().load)
+    except Exception:
+        logger.exception("Background storage load failed")
+        return
+    STATE.sync()
+    logger.info("Storage loaded in background in %.0f ms", (perf_counter() - started) * 1000)
+
+def start_warm_up() -> asyncio.Task:
+    """Пуска пълното зареждане на хранилището във фонов поток (ако още не е пуснато)."""
+    global _WARM_UP
+    loop = asyncio.get_running_loop()
+    if _WARM_UP is None or _WARM_UP.get_loop() is not loop or (_WARM_UP.done() and not STATE.synced):
+        _WARM_UP = loop.create_task(_warm_up(), name="storage-warm-up")
+    return _WARM_UP
+
+async def warm_up() -> None:
+    """Изчаква пълното зареждане на хранилището (пуска го, ако трябва)."""
+    if not STATE.synced:
+        await asyncio.shield(start_warm_up())
+
+# ------------------ ИСТОРИЯ И АРХИВ ------------------
+# В хранилището стоят само последните HISTORY_HOT_DAYS дни. По-старите се преместват в
+# компресирани месечни файлове ARCHIVE_DIR/ГГГГ-ММ.json.gz (read_archive_month чете цял месец;
+# /find и /export ги четат при нужда).
+HISTORY_HOT_DAYS = int(os.getenv("HISTORY_HOT_DAYS", "60"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+RETENTION_HOUR = int(os.getenv("RETENTION_HOUR", "3"))  # нощна поддръжка
+
+def archive_path(month: str, directory: Optional[str] = None) -> str:
+    return os.path.join(directory or ARCHIVE_DIR, f"{month}.json.gz")
+
+def archive_months(directory: Optional[str] = None) -> List[str]:
+    directory = directory or ARCHIVE_DIR
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n[:-len(".json.gz")] for n in os.listdir(directory) if n.endswith(".json.gz"))
+
+def read_archive_month(month: str, directory: Optional[str] = None) -> Dict[str, Dict[str, List[str]]]:
+    """{topic_key: {ден: [артикули]}} за един архивиран месец."""
+    path = archive_path(month, directory)
+    if not os.path.exists(path):
+        return {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f).get("lists", {})
+
+def _write_archive_month(month: str, lists: Dict[str, Dict[str, List[str]]], directory: Optional[str] = None) -> int:
+    merged = read_archive_month(month, directory)
+    for k, days in lists.items():
+        merged.setdefault(k, {}).update(days)  # един ден винаги се презаписва цял → идемпотентно
+    os.makedirs(directory or ARCHIVE_DIR, exist_ok=True)
+    path = archive_path(month, directory)
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump({"lists": merged}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+def run_retention(hot_days: int = HISTORY_HOT_DAYS) -> Dict[str, int]:
+    """Архивира и премахва дните извън прозореца. Синхронна – викай я през asyncio.to_thread."""
+    storage = get_storage()
+    cutoff = (datetime.now(TIMEZONE) - timedelta(days=hot_days)).strftime("%Y-%m-%d")
+    old = storage.days_before(cutoff)
+    by_month: Dict[str, Dict[str, Dict[str, List[str]]]] = {}
+    items = 0
+    for k, days in old.items():
+        for day, day_items in days.items():
+            by_month.setdefault(day[:7], {}).setdefault(k, {})[day] = day_items
+            items += len(day_items)
+    size_before = storage.disk_size()
+    # Първо архив, после триене: срив по средата оставя данните на две места, но не ги губи
+    archive_bytes = sum(_write_archive_month(month, lists) for month, lists in sorted(by_month.items()))
+    days, msgs = storage.drop_days_before(cutoff)
+    if days or msgs:
+        storage.compact()
+    report = {
+        "cutoff": cutoff,
+        "days": days,
+        "items": items,
+        "list_msgs": msgs,
+        "months": len(by_month),
+        "bytes_reclaimed": max(0, size_before - storage.disk_size()),
+        "archive_bytes": archive_bytes,
+    }
+    logger.info("Retention: %s", report)
+    return report
+
+def format_retention_report(report: Dict) -> str:
+    return (
+        f"Архивирани дни преди {report['cutoff']}: {report['days']} "
+        f"({report['items']} артикула, {report['list_msgs']} list-съобщения) в {report['months']} месечни файла.\n"
+        f"Освободени: {report['bytes_reclaimed']} байта; архивът зае {report['archive_bytes']} байта."
+    )
+
+# --- експорт ---
+# /export и `export` в CLI пишат редовете поточно. Архивът се чете месец по месец, а SQLite
+# – с курсор, така че с тях в паметта не стои цялата история. JSON хранилището е изключение:
+# iter_history минава ден по ден, но през data(), т.е. цялата снимка + журнал са в паметта
+# (в бота те и без това са заредени; в CLI се зареждат за експорта). С нощното архивиране
+# това са само последните HISTORY_HOT_DAYS дни; за многогодишна история без архив – SQLite.
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ("date", "topic", "position", "item")
+EXPORT_SPOOL_BYTES = 1024 * 1024  # до толкова файлът за изпращане стои в паметта, после – на диск
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит на Bot API за качване на документ
+def _export_day(value: str, last: bool) -> str:
+    """"ГГГГ-ММ-ДД" или "ГГГГ-ММ" (→ първият/последният ден на месеца) като ключ на ден."""
+    for fmt in ("%Y-%m-%d", "%Y-%m"):
+        try:
+            day = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt == "%Y-%m" and last:
+            day = (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        return day.strftime("%Y-%m-%d")
+    raise ValueError(f"„{value}“ не е дата във формат ГГГГ-ММ-ДД или ГГГГ-ММ")
+
+def parse_export_range(start: str, end: Optional[str] = None) -> Tuple[str, str]:
+    """("2026-09", None) → ("2026-09-01", "2026-09-30"); без end периодът е само start."""
+    start, end = _export_day(start, False), _export_day(end or start, True)
+    if start > end:
+        raise ValueError("началната дата е след крайната")
+    return start, end
+
+def _topic_matches(key: str, chat_id: Optional[int], k: Optional[str]) -> bool:
+    if k is not None:
+        return key == k
+    return chat_id is None or key.startswith(f"{chat_id}{SEP}")
+
+def iter_export_rows(start: str, end: str, chat_id: Optional[int] = None,
+                     k: Optional[str] = None) -> Iterator[Tuple[str, str, int, str]]:
+    """(ден, topic_key, позиция, артикул) от архива и хранилището, подредени по ден."""
+    storage = get_storage()
+    for month in archive_months():
+        if not start[:7] <= month <= end[:7]:
+            continue
+        lists = read_archive_month(month)
+        docs = sorted((day, key) for key, days in lists.items() if _topic_matches(key, chat_id, k)
+                      for day in days if start <= day <= end)
+        for day, key in docs:
+            if storage.get_items(key, day):
+                continue  # денят е и в хранилището (прекъснато архивиране) – идва оттам
+            for pos, text in enumerate(lists[key][day], 1):
+                yield day, key, pos, text
+    yield from storage.iter_history(start, end, chat_id, k)
+
+def write_export(rows: Iterator[Tuple[str, str, int, str]], out: IO[str], fmt: str) -> int:
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+    for row in rows:
+        out.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+def build_export_file(start: str, end: str, fmt: str, chat_id: Optional[int] = None,
+                      k: Optional[str] = None) -> Tuple[IO[bytes], int]:
+    """Експортът във временен файл (в паметта до EXPORT_SPOOL_BYTES). Синхронна."""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    out = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+    count = write_export(iter_export_rows(start, end, chat_id, k), out, fmt)
+    out.flush()
+    out.detach()
+    spool.seek(0)
+    return spool, count
+
+# ------------------ ОБОБЩЕНИЕ ------------------
+# /summary събира днешните артикули от всички активни Topics на чата. Артикулите се групират
+# по нормализиран ключ: малки букви, ё→е, без пунктуация и начално количество ("2 бр.", "3x"),
+# думите подредени и без служебните ("за", "и", ...). Така "Хартиено тиксо" и "2 бр. тиксо,
+# хартиено" са един ред с количество 3. Сборът се поддържа от помощниците за списъка:
+# добавяне струва O(добавените), редакция – O(списъка на Topic-а), без обхождане на останалите.
+SUMMARY_TIME = os.getenv("SUMMARY_TIME", "12:00").strip()  # автоматичен отчет; празно → изключен
+
+_STOPWORDS = {"за", "и", "на", "от", "с", "със", "в", "във", "до", "по", "the", "for", "and", "of"}
+# "2 тиксо", "2x тиксо", "2 x тиксо", "2 бр. тиксо", "2броя тиксо" – но не "3M тиксо"
+_QTY_RE = re.compile(r"^\s*(\d{1,4})\s*(?:[xх×](?=\s)\s*|(?:бр\.?|броя|брой|pcs\.?)\s*|\s+)", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+")
+
+def fold_text(text: str) -> str:
+    """Сгъване за сравнение: малки букви (вкл. кирилица) и ё → е."""
+    return text.casefold().replace("ё", "е")
+
+def split_quantity(text: str) -> Tuple[int, str]:
+    """"3 бр. тиксо" → (3, "тиксо"); без начално количество → (1, текста)."""
+    m = _QTY_RE.match(text)
+    if m and m.end() < len(text):
+        return max(1, int(m.group(1))), text[m.end():].strip()
+    return 1, text.strip()
+
+def item_key(text: str) -> str:
+    _, rest = split_quantity(text)
+    words = [w for w in _WORD_RE.findall(fold_text(rest)) if w not in _STOPWORDS]
+    return " ".join(sorted(words)) or fold_text(rest).strip()
+
+class DailySummary:
+    """Днешният сбор по чат: ключ → общо количество и количество по Topic.
+
+    Чатът се зарежда от хранилището при първото поискване за деня; след това само се
+    обновява. self.topics съдържа точно активните Topics на заредените чатове, затова
+    промени в незаредени чатове или неактивни Topics се пренебрегват.
+    """
+
+    def __init__(self):
+        self.day = ""
+        self.topics: Dict[str, Dict[str, int]] = {}  # topic_key -> {ключ: количество}
+        self.chats: Dict[int, Dict[str, Dict]] = {}  # chat_id -> {ключ: {"qty", "topics", "label"}}
+
+    def _check_day(self) -> None:
+        day = today_key()
+        if day != self.day:
+            self.day = day
+            self.topics.clear()
+            self.chats.clear()
+
+    def chat(self, chat_id: int) -> Dict[str, Dict]:
+        self._check_day()
+        if chat_id not in self.chats:
+            self.chats[chat_id] = {}
+            prefix = f"{chat_id}{SEP}"
+            for k in get_enabled_topics():
+                if k.startswith(prefix):
+                    self._set(k, get_today(k))
+        return self.chats[chat_id]
+
+    def _set(self, k: str, items: List[str]) -> None:
+        entries = self.chats[parse_topic_key(k)[0]]
+        counts: Dict[str, int] = {}
+        labels: Dict[str, str] = {}
+        for text in items:
+            qty, label = split_quantity(text)
+            key = item_key(text)
+            counts[key] = counts.get(key, 0) + qty
+            labels.setdefault(key, label)
+        old = self.topics.get(k, {})
+        for key in set(old) | set(counts):
+            delta = counts.get(key, 0) - old.get(key, 0)
+            if not delta:
+                continue
+            entry = entries.setdefault(key, {"qty": 0, "topics": {}, "label": labels.get(key, key)})
+            entry["qty"] += delta
+            if counts.get(key):
+                entry["topics"][k] = counts[key]
+            else:
+                entry["topics"].pop(k, None)
+            if entry["qty"] <= 0:
+                del entries[key]
+        self.topics[k] = counts
+
+    def _tracked(self, k: str) -> bool:
+        self._check_day()
+        return k in self.topics
+
+    def add(self, k: str, items: List[str]) -> None:
+        if not self._tracked(k):
+            return
+        entries = self.chats[parse_topic_key(k)[0]]
+        counts = self.topics[k]
+        for text in items:
+            qty, label = split_quantity(text)
+            key = item_key(text)
+            counts[key] = counts.get(key, 0) + qty
+            entry = entries.setdefault(key, {"qty": 0, "topics": {}, "label": label})
+            entry["qty"] += qty
+            entry["topics"][k] = counts[key]
+
+    def set(self, k: str, items: List[str]) -> None:
+        if self._tracked(k):
+            self._set(k, items)
+
+    def enable(self, k: str) -> None:
+        self._check_day()
+        if parse_topic_key(k)[0] in self.chats and k not in self.topics:
+            self._set(k, get_today(k))
+
+    def disable(self, k: str) -> None:
+        if self._tracked(k):
+            self._set(k, [])
+            del self.topics[k]
+
+SUMMARY = DailySummary()
+
+def render_summary(chat_id: int, limit: Optional[int] = None) -> List[str]:
+    """Отчетът за чата, разделен на съобщения до limit знака."""
+    limit = limit or LIST_PAGE_LIMIT
+    entries = SUMMARY.chat(chat_id)
+    if not entries:
+        return ["Днес още няма артикули в активните Topics на този чат."]
+    topics = {k for e in entries.values() for k in e["topics"]}
+    total = sum(e["qty"] for e in entries.values())
+    day = datetime.strptime(SUMMARY.day, "%Y-%m-%d").strftime("%d.%m.%Y")
+    lines = []
+    for e in sorted(entries.values(), key=lambda e: (-e["qty"], fold_text(e["label"]))):
+        line = f"• {e['label']} – {e['qty']}"
+        if len(e["topics"]) > 1:
+            line += f" ({len(e['topics'])} офиса)"
+        lines.append(line)
+    messages = [f"📦 Обща заявка за {day}: {total} бр. в {len(entries)} позиции от {len(topics)} Topic-а"]
+    for line in lines:
+        if len(messages[-1]) + 1 + len(line) > limit:
+            messages.append(line[:limit])
+        else:
+            messages[-1] += "\n" + line
+    return messages
+
+def get_summary_topics() -> Dict[str, str]:
+    """chat_id (като текст) → topic_key, където се праща автоматичният отчет."""
+    return get_storage().get_meta("summary_topics", {})
+
+def set_summary_topic(chat_id: int, k: Optional[str]) -> None:
+    topics = get_summary_topics()
+    if k is None:
+        topics.pop(str(chat_id), None)
+    else:
+        topics[str(chat_id)] = k
+    get_storage().set_meta("summary_topics", topics)
+
+# ------------------ ТЪРСЕНЕ ------------------
+# /find <текст> търси в цялата история на чата (хранилище + архив) през обратен индекс:
+# дума → артикулите (topic_key, ден, позиция), в които се среща. Думите се сгъват като при
+# /summary (малки букви, ё→е, без пунктуация и служебни думи); последната дума от заявката се
+# търси и като начало на дума ("букс" намира "букса"). Индексът се строи веднъж при първото
+# търсене (в отделна нишка) и после се поддържа от помощниците за списъка; отговорът чете
+# само текстовете на намерените артикули, а не цели дни.
+FIND_LIMIT = int(os.getenv("FIND_LIMIT", "10"))
+_ALL_DAYS = "9999-12-31"  # days_before(_ALL_DAYS) → всички дни в хранилището
+
+def search_words(text: str) -> List[str]:
+    return [w for w in _WORD_RE.findall(fold_text(text)) if w not in _STOPWORDS]
+
+_FIND_CHUNK = 4096  # документи в една C операция на find() – между тях нишката пуска GIL-а
+
+def _find_chunks(arrays: List[Tuple[array, int]]) -> Iterator[array]:
+    for docs, n in arrays:
+        for i in range(0, n, _FIND_CHUNK):
+            yield docs[i:min(i + _FIND_CHUNK, n)]
+
+class SearchIndex:
+    """Обратен индекс по чат; документ е един артикул (topic_key, ден, позиция).
+    find() върви в нишка, докато add()/set() идват от event loop-а – общото състояние
+    се пипа само под self._lock, а дългото строене става в отделен обект (_build).
+
+    Стотиците хиляди документа не бива да удължават пълните обхождания на gc (те държат
+    GIL-а, значи и event loop-а): документът е едно число (ден, Topic, позиция), а списъкът
+    за думата е array – gc не обхожда нито едното. Думите по артикул се пазят само за днес,
+    единствения ден, който set() може да промени. Изтритото от днешния списък не се маха
+    от масивите – find() така или иначе проверява текста на всеки кандидат."""
+
+    def __init__(self):
+        self.loaded = False
+        self.today = ""
+        self.today_words: Dict[str, List[Tuple[str, ...]]] = {}  # topic_key -> думите по днешна позиция
+        self.today_len: Dict[str, int] = {}  # topic_key -> брой днешни артикули
+        self.postings: Dict[int, Dict[str, array]] = {}  # chat_id -> дума -> документи
+        self.vocab: Dict[int, List[str]] = {}  # chat_id -> сортирани думи (за търсене по начало)
+        self.topics: List[str] = []  # номер на Topic в документа -> topic_key
+        self.topic_ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._build_lock: Optional[asyncio.Lock] = None
+        self._dirty: set = set()  # Topics, променени днес преди индексът да е готов
+
+    # Документ: ден (пореден номер по григорианския календар) << 44 | Topic << 20 | позиция
+    def _doc_base(self, k: str, day: str) -> int:
+        topic = self.topic_ids.get(k)
+        if topic is None:
+            topic = self.topic_ids[k] = len(self.topics)
+            self.topics.append(k)
+        return datetime.fromisoformat(day).toordinal() << 44 | topic << 20
+
+    def _parse_doc(self, doc: int) -> Tuple[str, str, int]:
+        day = datetime.fromordinal(doc >> 44).strftime("%Y-%m-%d")
+        return self.topics[(doc >> 20) & 0xFFFFFF], day, doc & 0xFFFFF
+
+    def _build(self) -> "SearchIndex":
+        """Чете архива и хранилището в нов обект – бавно, затова в нишка."""
+        started = perf_counter()
+        fresh = SearchIndex()
+        fresh.today = today_key()
+        count = 0
+        for month in archive_months():
+            for k, days in read_archive_month(month).items():
+                for day, items in days.items():
+                    fresh._append(k, day, items)
+                    count += len(items)
+        for k, days in get_storage().days_before(_ALL_DAYS).items():
+            for day, items in days.items():
+                fresh._append(k, day, items)
+                count += len(items)
+        logger.info("Search index: %d items, %d chats in %.0f ms",
+                    count, len(fresh.postings), (perf_counter() - started) * 1000)
+        return fresh
+
+    def _adopt(self, fresh: "SearchIndex") -> None:
+        """Включва построения индекс. Вика се от event loop-а: там add()/set() не могат да се
+        вмъкнат между записа в хранилището и индекса, така че днешните Topics, променени
+        докато индексът се е строил, се четат наново точно веднъж."""
+        with self._lock:
+            for name in ("today", "today_words", "today_len", "postings", "vocab", "topics", "topic_ids"):
+                setattr(self, name, getattr(fresh, name))
+            for k in self._dirty:
+                self._set_today(k, get_storage().get_items(k, today_key()))
+            self._dirty.clear()
+            self.loaded = True
+
+    def load(self) -> None:
+        self._adopt(self._build())
+
+    async def ensure_loaded(self) -> None:
+        if self._build_lock is None:
+            self._build_lock = asyncio.Lock()
+        async with self._build_lock:
+            if not self.loaded:
+                self._adopt(await asyncio.to_thread(self._build))
+
+    def _roll_day(self) -> str:
+        day = today_key()
+        if day != self.today:
+            self.today, self.today_words, self.today_len = day, {}, {}
+        return day
+
+    def _append(self, k: str, day: str, items: List[str], start: int = 0) -> None:
+        chat_id = parse_topic_key(k)[0]
+        postings = self.postings.setdefault(chat_id, {})
+        base = self._doc_base(k, day)
+        current = None
+        if day == self.today:
+            current = self.today_words.setdefault(k, [])
+            self.today_len[k] = start + len(items)
+        for pos, text in enumerate(items, start):
+            words = tuple(dict.fromkeys(search_words(text)))
+            doc = base | pos
+            old = current[pos] if current is not None and pos < len(current) else ()
+            for word in words:
+                if word in old:
+                    continue  # документът вече е в масива на думата
+                docs = postings.get(word)
+                if docs is None:
+                    docs = postings[word] = array("Q")
+                    bisect.insort(self.vocab.setdefault(chat_id, []), word)
+                docs.append(doc)
+            if current is not None:
+                if pos < len(current):
+                    current[pos] = tuple(dict.fromkeys(old + words))
+                else:
+                    current.append(words)
+
+    def _set_today(self, k: str, items: List[str]) -> None:
+        """Заменя днешните артикули на k – позициите се местят при /edit."""
+        day = self._roll_day()
+        # Думите на старите позиции остават в current: така същият документ не се добавя
+        # втори път в масива на думата, а излишните кандидати отпадат при проверката в find()
+        self._append(k, day, items)
+
+    def add(self, k: str, items: List[str]) -> None:
+        with self._lock:
+            if self.loaded:
+                day = self._roll_day()
+                self._append(k, day, items, self.today_len.get(k, 0))
+            else:
+                self._dirty.add(k)
+
+    def set(self, k: str, items: List[str]) -> None:
+        with self._lock:
+            if self.loaded:
+                self._set_today(k, items)
+            else:
+                self._dirty.add(k)
+
+    def _sources(self, chat_id: int, full: List[str], last: str) -> List[List[Tuple[array, int]]]:
+        """За всяка дума от заявката – масивите ѝ и дължините им в момента (последната дума
+        е всички думи с това начало). Масивите само растат, затова извън self._lock се четат
+        до запомнената дължина."""
+        with self._lock:
+            vocab = self.vocab.get(chat_id, [])
+            postings = self.postings.get(chat_id, {})
+            prefixed = []
+            i = bisect.bisect_left(vocab, last)
+            while i < len(vocab) and vocab[i].startswith(last):
+                prefixed.append((postings[vocab[i]], len(postings[vocab[i]])))
+                i += 1
+            sources = [prefixed]
+            for word in full:
+                docs = postings.get(word)
+                sources.append([(docs, len(docs))] if docs is not None else [])
+        return sources
+
+    def _newest(self, docs: set) -> Iterator[Tuple[str, str, int]]:
+        """(topic_key, ден, позиция) от най-новия ден назад; в деня – по topic_key и позиция.
+        Купчина вместо пълно сортиране: обикновено стигат първите няколко дни."""
+        heap = [-doc for doc in docs]
+        heapq.heapify(heap)
+        while heap:
+            day = -heap[0] >> 44
+            same = []
+            while heap and -heap[0] >> 44 == day:
+                same.append(self._parse_doc(-heapq.heappop(heap)))
+            yield from sorted(same, key=lambda doc: (doc[0], doc[2]), reverse=True)
+
+    def find(self, chat_id: int, query: str, limit: int = FIND_LIMIT) -> List[Tuple[str, str, str]]:
+        """Най-новите до limit артикула с всички думи от query: [(ден, topic_key, текст)].
+        Чете хранилището и архива – от event loop-а се вика през asyncio.to_thread след
+        ensure_loaded()."""
+        if not self.loaded:
+            self.load()
+        words = search_words(query)
+        if not words:
+            return []
+        *full, last = words
+        # От най-късия списък: всяка C операция е върху _FIND_CHUNK документа
+        sources = sorted(self._sources(chat_id, full, last), key=lambda src: sum(n for _, n in src))
+        candidates: set = set()
+        for chunk in _find_chunks(sources[0]):
+            candidates.update(chunk)
+        for src in sources[1:]:
+            if not candidates:
+                return []
+            keep: set = set()
+            for chunk in _find_chunks(src):
+                keep.update(candidates.intersection(chunk))
+            candidates = keep
+        found = []
+        days: Dict[Tuple[str, str], List[str]] = {}
+        months: Dict[str, Dict[str, Dict[str, List[str]]]] = {}
+        for k, day, pos in self._newest(candidates):
+            items = days.get((k, day))
+            if items is None:
+                items = get_storage().get_items(k, day)
+                if not items:
+                    if day[:7] not in months:
+                        months[day[:7]] = read_archive_month(day[:7])
+                    items = months[day[:7]].get(k, {}).get(day, [])
+                days[(k, day)] = items
+            if pos >= len(items):
+                continue  # изтрит от днешния списък
+            item_words = search_words(items[pos])
+            if all(w in item_words for w in full) and any(w.startswith(last) for w in item_words):
+                found.append((day, k, items[pos]))
+                if len(found) >= limit:
+                    break
+        return found
+
+SEARCH = SearchIndex()
+
+def render_find(query: str, results: List[Tuple[str, str, str]], ms: float) -> str:
+    if not results:
+        return f"🔎 Няма намерени артикули за „{query}“."
+    lines = [f"🔎 „{query}“ – последни {len(results)} ({ms:.1f} ms):"]
+    for day, k, text in results:
+        _, thread_id = parse_topic_key(k)
+        where = f"Topic {thread_id}" if thread_id else "общ чат"
+        lines.append(f"• {datetime.strptime(day, '%Y-%m-%d'):%d.%m.%Y} · {where}: {text}")
+    return "\n".join(lines)[:LIST_PAGE_LIMIT]
+
+# ------------------ ИЗХОДЯЩИ ЗАЯВКИ (Bot API) ------------------
+# Всички извиквания към Bot API минават през една опашка (API). Тя спазва общия лимит
+# (~30 заявки/сек) и лимита за чат (~20 съобщения/мин в група), подрежда заявките по
+# приоритет (списъкът е преди временните известия) и при RetryAfter изчаква и опитва отново.
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))      # заявки/сек общо
+API_GROUP_PER_MIN = float(os.getenv("API_GROUP_PER_MIN", "20"))  # съобщения/мин за група
+API_PRIVATE_RATE = float(os.getenv("API_PRIVATE_RATE", "1"))     # съобщения/сек за личен чат
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "5"))
+
+PRIO_ANSWER = 0   # отговори на бутони и стъпки от /edit
+PRIO_LIST = 1     # "Днешният списък:" и дневното съобщение
+PRIO_DEFAULT = 2
+PRIO_NOTICE = 3   # временни известия ("Списъкът е обновен.", PRIO_NOTICE)
+PRIO_CLEANUP = 4  # изтриване на съобщения
+
+# Методи, които не се броят към лимита за чат (само към общия)
+_FREE_IN_CHAT = {"answer_callback_query", "delete_message", "delete_messages"}
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def ready_at(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return max(now, self.blocked_until)
+        return max(now + (1 - self.tokens) / self.rate, self.blocked_until)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+class ApiScheduler:
+    def __init__(self):
+        self._queues: Dict[Optional[int], List] = {}  # chat_id -> heap от (prio, seq, job)
+        self._buckets: Dict[Optional[int], _TokenBucket] = {}
+        self._global = _TokenBucket(API_GLOBAL_RATE, API_GLOBAL_RATE)
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.timings: Optional[Dict[str, List]] = None  # метод -> [брой, сек.], докато тече /profile
+
+    def _bucket(self, chat_id: Optional[int]) -> _TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id is not None and chat_id < 0:
+                bucket = _TokenBucket(API_GROUP_PER_MIN / 60.0, API_GROUP_PER_MIN)
+            else:
+                bucket = _TokenBucket(API_PRIVATE_RATE, 3 * API_PRIVATE_RATE)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values()) + len(self._inflight)
+
+    def _push(self, chat_id: Optional[int], prio: int, seq: int, job: Dict) -> None:
+        heapq.heappush(self._queues.setdefault(chat_id, []), (prio, seq, job))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def call(self, chat_id: Optional[int], method: str, factory: Callable[[], Awaitable], prio: int = PRIO_DEFAULT):
+        """Поставя заявка в опашката и чака резултата ѝ."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="bot-api-scheduler")
+        fut = asyncio.get_running_loop().create_future()
+        job = {"method": method, "factory": factory, "future": fut, "tries": 0, "queued": monotonic()}
+        self._push(chat_id, prio, next(self._seq), job)
+        return await fut
+
+    def _pick(self, now: float) -> Tuple[Optional[Tuple], float]:
+        # Избира най-приоритетната заявка сред чатовете, които имат свободен капацитет
+        best = None
+        next_at = float("inf")
+        for chat_id, q in list(self._queues.items()):
+            if not q:
+                del self._queues[chat_id]
+                continue
+            prio, seq, job = q[0]
+            if job["method"] in _FREE_IN_CHAT:
+                ready = max(now, self._bucket(chat_id).blocked_until)
+            else:
+                ready = self._bucket(chat_id).ready_at(now)
+            if ready > now:
+                next_at = min(next_at, ready)
+            elif best is None or (prio, seq) < best[:2]:
+                best = (prio, seq, chat_id)
+        return best, next_at
+
+    async def _run(self) -> None:
+        while True:
+            now = monotonic()
+            best, next_at = self._pick(now)
+            if best is not None:
+                g_ready = self._global.ready_at(now)
+                if g_ready <= now:
+                    chat_id = best[2]
+                    _, seq, job = heapq.heappop(self._queues[chat_id])
+                    self._global.take()
+                    if job["method"] not in _FREE_IN_CHAT:
+                        self._bucket(chat_id).take()
+                    task = asyncio.get_running_loop().create_task(self._dispatch(chat_id, best[0], seq, job))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
+                    continue
+                next_at = min(next_at, g_ready)
+            self._wakeup.clear()
+            timeout = None if next_at == float("inf") else max(0.0, next_at - monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, chat_id: Optional[int], prio: int, seq: int, job: Dict) -> None:
+        fut = job["future"]
+        if fut.done():  # викащият се е отказал
+            return
+        method = job["method"]
+        started = perf_counter()
+        if METRICS_ENABLED:
+            METRICS.observe("bot_api_queue_seconds", monotonic() - job["queued"], method=method)
+            METRICS.inc("bot_api_calls_total", method=method)
+        try:
+            result = await job["factory"]()
+        except RetryAfter as e:
+            if fut.done():  # викащият се е отказал, докато заявката е била в полет
+                return
+            job["tries"] += 1
+            wait = float(e.retry_after)
+            if METRICS_ENABLED:
+                METRICS.inc("bot_api_errors_total", method=method, error="RetryAfter")
+                METRICS.inc("bot_api_retry_after_seconds_total", wait, method=method)
+            logger.warning("RetryAfter %.0fs for %s in chat %s (try %d)", wait, job["method"], chat_id, job["tries"])
+            if job["tries"] > API_MAX_RETRIES:
+                fut.set_exception(e)
+                return
+            bucket = self._bucket(chat_id)
+            bucket.blocked_until = max(bucket.blocked_until, monotonic() + wait)
+            job["queued"] = monotonic()
+            self._push(chat_id, prio, seq, job)  # запазва мястото си в реда
+        except BaseException as e:
+            if METRICS_ENABLED:
+                METRICS.inc("bot_api_errors_total", method=method, error=type(e).__name__)
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
+        finally:
+            if METRICS_ENABLED:
+                METRICS.observe("bot_api_seconds", perf_counter() - started, method=method)
+            if self.timings is not None:
+                stat = self.timings.setdefault(method, [0, 0.0])
+                stat[0] += 1
+                stat[1] += perf_counter() - started
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Изчаква опашката да се изпразни (до timeout) и спира."""
+        deadline = monotonic() + timeout
+        while self.pending() and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+API = ApiScheduler()
+
+async def bot_call(context: ContextTypes.DEFAULT_TYPE, method: str, prio: int = PRIO_DEFAULT, **kwargs):
+    """context.bot.<method>(**kwargs) през общата опашка."""
+    bot = context.bot
+    return await API.call(kwargs.get("chat_id"), method, lambda: getattr(bot, method)(**kwargs), prio)
+
+async def answer_query(context: ContextTypes.DEFAULT_TYPE, query, text: Optional[str] = None) -> None:
+    await bot_call(context, "answer_callback_query", PRIO_ANSWER, callback_query_id=query.id, text=text)
+
+async def edit_query_text(context: ContextTypes.DEFAULT_TYPE, query, text: str, reply_markup=None) -> None:
+    await bot_call(
+        context, "edit_message_text", PRIO_ANSWER,
+        chat_id=query.message.chat.id, message_id=query.message.message_id, text=text, reply_markup=reply_markup,
+    )
+
+async def delete_message_safe(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int) -> None:
+    try:
+        await bot_call(context, "delete_message", PRIO_CLEANUP, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.debug("delete_message %s/%s failed: %s", chat_id, message_id, e)
+
+# ------------------ ПОМОЩНИЦИ ------------------
+# Редакциите на "Днешният списък:" се обединяват: поредица добавяния в един Topic води до
+# една редакция след LIST_EDIT_DEBOUNCE сек. тишина (но не по-късно от LIST_EDIT_MAX_DELAY
+# от първата заявка). Ако текстът съвпада с последно изпратения, редакция изобщо не се прави.
+LIST_EDIT_DEBOUNCE = float(os.getenv("LIST_EDIT_DEBOUNCE", "1.0"))
+LIST_EDIT_MAX_DELAY = float(os.getenv("LIST_EDIT_MAX_DELAY", "4.0"))
+
+#
+# Списък над LIST_PAGE_LIMIT знака (Telegram спира на 4096) се показва в няколко съобщения-
+# страници. Последно изпратеният текст на всяка страница се помни и се редактират само
+# страниците, чийто текст се е променил – добавяне в края на дълъг списък струва една редакция.
+LIST_PAGE_LIMIT = int(os.getenv("LIST_PAGE_LIMIT", "4000"))
+LIST_PIN_PAGES = os.getenv("LIST_PIN_PAGES", "1") == "1"
+
+_PENDING_LIST_UPDATES: Dict[str, Dict] = {}
+_LIST_PAGE_TEXT: Dict[str, Dict[int, str]] = {}  # topic_key -> {message_id: текст}
+LIST_EDIT_STATS = {"requested": 0, "edits": 0, "sent": 0, "skipped_same": 0, "coalesced": 0, "deleted": 0}
+
+async def send_in_topic(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], text: str,
+                        prio: int = PRIO_DEFAULT, **extra):
+    kwargs = {"chat_id": chat_id, "text": text, **extra}
+    if thread_id is not None and thread_id != 0:
+        kwargs["message_thread_id"] = thread_id
+    return await bot_call(context, "send_message", prio, **kwargs)
+
+async def send_document_in_topic(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int],
+                                 data: bytes, filename: str, caption: Optional[str] = None, prio: int = PRIO_DEFAULT):
+    kwargs = {"chat_id": chat_id, "document": data, "filename": filename, "caption": caption}
+    if thread_id is not None and thread_id != 0:
+        kwargs["message_thread_id"] = thread_id
+    return await bot_call(context, "send_document", prio, **kwargs)
+
+async def _send_list_pages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str,
+                           pages: List[str]) -> List[int]:
+    """Изпраща страниците като нови съобщения (и ги закача, ако LIST_PIN_PAGES)."""
+    cache = _LIST_PAGE_TEXT.setdefault(k, {})
+    ids = []
+    for text in pages:
+        sent = await send_in_topic(context, chat_id, thread_id, text, PRIO_LIST)
+        cache[sent.message_id] = text
+        ids.append(sent.message_id)
+        LIST_EDIT_STATS["sent"] += 1
+        if LIST_PIN_PAGES:
+            try:
+                await bot_call(context, "pin_chat_message", PRIO_LIST, chat_id=chat_id,
+                               message_id=sent.message_id, disable_notification=True)
+            except Exception as e:
+                # Без права за закачане страниците просто остават незакачени
+                logger.debug("pin_chat_message %s/%s failed: %s", chat_id, sent.message_id, e)
+    return ids
+
+_LIST_LOCKS: Dict[str, asyncio.Lock] = {}
+
+def list_lock(k: str) -> asyncio.Lock:
+    """Сериализира изпращането/редакцията на list-съобщенията на Topic-а: две обновявания
+    едновременно биха прочели едни и същи стари id-та и пратили страниците два пъти."""
+    lock = _LIST_LOCKS.get(k)
+    if lock is None:
+        lock = _LIST_LOCKS[k] = asyncio.Lock()
+    return lock
+
+async def ensure_list_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> int:
+    async with list_lock(k):
+        msg_ids = get_list_message_ids(k)
+        if not msg_ids:
+            msg_ids = await _send_list_pages(context, chat_id, thread_id, k, render_list_pages(get_today(k)))
+            set_list_message_ids(k, msg_ids)
+        return msg_ids[0]
+
+async def update_list_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> None:
+    async with list_lock(k):
+        pages = render_list_pages(get_today(k))
+        old_ids = get_list_message_ids(k)
+        cache = _LIST_PAGE_TEXT.setdefault(k, {})
+        ids: List[int] = []
+        for msg_id, text in zip(old_ids, pages):
+            if cache.get(msg_id) == text:
+                LIST_EDIT_STATS["skipped_same"] += 1
+                ids.append(msg_id)
+                continue
+            try:
+                await bot_call(context, "edit_message_text", PRIO_LIST, chat_id=chat_id, message_id=msg_id, text=text)
+            except BadRequest as e:
+                # Нова страница само ако старата е недостъпна (изтрита и т.н.), не при лимити/мрежа.
+                # Следващите страници се пращат наново след нея, за да се запази редът.
+                if "not modified" not in str(e).lower():
+                    break
+            cache[msg_id] = text
+            ids.append(msg_id)
+            LIST_EDIT_STATS["edits"] += 1
+        if len(ids) < len(pages):
+            ids += await _send_list_pages(context, chat_id, thread_id, k, pages[len(ids):])
+        # Излишни страници (списъкът е намалял или е преизпратен) – изтриват се
+        for msg_id in old_ids:
+            if msg_id not in ids:
+                cache.pop(msg_id, None)
+                schedule_delete(context, chat_id, msg_id)
+                LIST_EDIT_STATS["deleted"] += 1
+        if ids != old_ids:
+            set_list_message_ids(k, ids)
+
+def request_list_update(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> None:
+    """Заявява обновяване на списъка; изпълнява се по-късно, обединено с останалите заявки."""
+    LIST_EDIT_STATS["requested"] += 1
+    now = monotonic()
+    pending = _PENDING_LIST_UPDATES.get(k)
+    if pending is not None:
+        pending["last"] = now
+        pending["count"] += 1
+        return
+    _PENDING_LIST_UPDATES[k] = {"first": now, "last": now, "count": 1}
+    context.application.create_task(
+        _debounced_list_update(context, chat_id, thread_id, k), name=f"list_update_{k}"
+    )
+
+async def _debounced_list_update(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> None:
+    while True:
+        pending = _PENDING_LIST_UPDATES[k]
+        due = min(pending["last"] + LIST_EDIT_DEBOUNCE, pending["first"] + LIST_EDIT_MAX_DELAY)
+        delay = due - monotonic()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+    pending = _PENDING_LIST_UPDATES.pop(k)
+    if pending["count"] > 1:
+        LIST_EDIT_STATS["coalesced"] += pending["count"] - 1
+        logger.info(
+            "List %s: %d updates coalesced into one edit (%d edits saved in total)",
+            k, pending["count"], LIST_EDIT_STATS["coalesced"] + LIST_EDIT_STATS["skipped_same"],
+        )
+    try:
+        await update_list_message(context, chat_id, thread_id, k)
+    except Exception:
+        logger.exception("Failed to update list message for %s", k)
+
+# ------------------ ИЗТРИВАНЕ НА ВРЕМЕННИ СЪОБЩЕНИЯ ------------------
+# Известията и изтритите потребителски съобщения не получават собствен таймер: влизат в
+# буфер по чат, който cleanup_job изпразва на всеки CLEANUP_INTERVAL сек. с delete_messages
+# (до 100 id-та на заявка). Буферът се пази в хранилището, за да се доизтрие след рестарт.
+CLEANUP_INTERVAL = float(os.getenv("CLEANUP_INTERVAL", "2.0"))
+DELETE_BATCH = 100  # лимит на Bot API за delete_messages
+
+_PENDING_DELETES: Dict[int, List[Tuple[float, int]]] = {}  # chat_id -> [(кога, message_id)]
+_pending_deletes_dirty = False
+
+def load_pending_deletes() -> None:
+    saved = STATE.pending_deletes()
+    _PENDING_DELETES.clear()
+    for chat_id, entries in saved.items():
+        _PENDING_DELETES[int(chat_id)] = [(float(due), int(mid)) for due, mid in entries]
+
+def _save_pending_deletes() -> None:
+    global _pending_deletes_dirty
+    _pending_deletes_dirty = False
+    STATE.set_pending_deletes(
+        {str(c): [[due, mid] for due, mid in e] for c, e in _PENDING_DELETES.items() if e}
+    )
+
+def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: float = 0) -> None:
+    global _pending_deletes_dirty
+    if context.job_queue is None:
+        spawn(context, delete_message_safe(context, chat_id, message_id))
+        return
+    _PENDING_DELETES.setdefault(chat_id, []).append((time_now() + delay, message_id))
+    _pending_deletes_dirty = True
+
+@instrumented
+async def cleanup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    now = time_now()
+    batches = []
+    for chat_id in list(_PENDING_DELETES):
+        entries = _PENDING_DELETES[chat_id]
+        due = [mid for when, mid in entries if when <= now]
+        if not due:
+            continue
+        rest = [(when, mid) for when, mid in entries if when > now]
+        if rest:
+            _PENDING_DELETES[chat_id] = rest
+        else:
+            del _PENDING_DELETES[chat_id]
+        batches.extend((chat_id, due[i:i + DELETE_BATCH]) for i in range(0, len(due), DELETE_BATCH))
+    if batches or _pending_deletes_dirty:
+        _save_pending_deletes()
+    if batches:
+        await asyncio.gather(*(_delete_batch(context, chat_id, ids) for chat_id, ids in batches))
+
+async def _delete_batch(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids: List[int]) -> None:
+    try:
+        if len(message_ids) == 1:
+            await bot_call(context, "delete_message", PRIO_CLEANUP, chat_id=chat_id, message_id=message_ids[0])
+        else:
+            await bot_call(context, "delete_messages", PRIO_CLEANUP, chat_id=chat_id, message_ids=message_ids)
+    except Exception as e:
+        logger.debug("Deleting %d messages in %s failed: %s", len(message_ids), chat_id, e)
+
+# ------------------ JOB ------------------
+# Една обща задача (daily_sweep_job) обикаля активираните Topics всяка минута. Topics, чийто
+# час е настъпил, се изчистват с една транзакция, а съобщенията се пращат на партиди с малко
+# случайно отместване, за да не удрят всички Topics Bot API в една и съща секунда.
+DAILY_SWEEP_INTERVAL = 60       # сек.
+DAILY_CATCHUP_MINUTES = int(os.getenv("DAILY_CATCHUP_MINUTES", "30"))  # закъснение след рестарт
+DAILY_BATCH_SIZE = int(os.getenv("DAILY_BATCH_SIZE", "10"))
+DAILY_BATCH_JITTER = float(os.getenv("DAILY_BATCH_JITTER", "2.0"))   # сек. между партидите (макс.)
+
+_SWEEP_LOCK = asyncio.Lock()
+
+async def send_daily_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], k: str) -> None:
+    today = datetime.now(TIMEZONE).strftime("%d.%m.%Y")
+    header = f"Дата {today}, списък за изпращане :"
+    await send_in_topic(context, chat_id, thread_id, header, PRIO_LIST)
+    await ensure_list_message(context, chat_id, thread_id, k)
+    await update_list_message(context, chat_id, thread_id, k)
+
+def due_daily_topics(now: datetime) -> List[str]:
+    """Активираните Topics, чийто час е настъпил днес и още не са обработени."""
+    day = now.strftime("%Y-%m-%d")
+    done = get_storage().get_meta("daily_done", {})
+    minutes_now = now.hour * 60 + now.minute
+    due = []
+    for k in get_enabled_topics():
+        if done.get(k) == day:
+            continue
+        hour, minute = get_topic_time(k)
+        late = minutes_now - (hour * 60 + minute)
+        if 0 <= late <= DAILY_CATCHUP_MINUTES:
+            due.append(k)
+    return due
+
+@instrumented
+async def daily_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if _SWEEP_LOCK.locked():
+        return  # предишното обикаляне още праща
+    await warm_up()  # след рестарт: изчистването и daily_done искат пълното хранилище
+    async with _SWEEP_LOCK:
+        now = datetime.now(TIMEZONE)
+        due = due_daily_topics(now)
+        if not due:
+            return
+        day = now.strftime("%Y-%m-%d")
+        storage = get_storage()
+        storage.clear_many(due, day)
+        for k in due:
+            bump_list_version(k)
+            SUMMARY.set(k, [])
+            SEARCH.set(k, [])
+        done = storage.get_meta("daily_done", {})
+        done = {k: d for k, d in done.items() if d == day}  # по-старите дни не ни трябват
+        done.update({k: day for k in due})
+        storage.set_meta("daily_done", done)
+
+        started = monotonic()
+        failed = 0
+        logger.info("Daily sweep: %d topics due", len(due))
+        for i in range(0, len(due), DAILY_BATCH_SIZE):
+            if i:
+                await asyncio.sleep(random.uniform(0, DAILY_BATCH_JITTER))
+            batch = due[i:i + DAILY_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(send_daily_prompt(context, *parse_topic_key(k), k) for k in batch), return_exceptions=True
+            )
+            for k, res in zip(batch, results):
+                if isinstance(res, Exception):
+                    failed += 1
+                    logger.warning("Daily prompt for %s failed: %s", k, res)
+            logger.info("Daily sweep: %d/%d topics sent", min(i + DAILY_BATCH_SIZE, len(due)), len(due))
+        logger.info(
+            "Daily sweep done: %d topics, %d failed, %.1fs", len(due), failed, monotonic() - started
+        )
+
+@instrumented
+async def retention_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await asyncio.to_thread(run_retention)
+    except Exception:
+        logger.exception("Retention failed")
+
+@instrumented
+async def summary_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Автоматичният отчет в абонираните Topics (само ако чатът има артикули днес)."""
+    for chat_id, k in get_summary_topics().items():
+        if not SUMMARY.chat(int(chat_id)):
+            continue
+        _, thread_id = parse_topic_key(k)
+        try:
+            for text in render_summary(int(chat_id)):
+                await send_in_topic(context, int(chat_id), thread_id, text)
+        except Exception:
+            logger.exception("Summary for chat %s failed", chat_id)
+
+@instrumented
+async def metrics_log_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info("Metrics: %s", METRICS.summary())
+
+def _observe_job_lag(job_queue, event) -> None:
+    # APScheduler EVENT_JOB_SUBMITTED: колко след планирания момент реално е тръгнала задачата
+    if not event.scheduled_run_times:
+        return
+    lag = (datetime.now(timezone.utc) - max(event.scheduled_run_times)).total_seconds()
+    job = job_queue.scheduler.get_job(event.job_id)
+    METRICS.observe("bot_job_lag_seconds", max(0.0, lag), job=job.name if job else event.job_id)
+
+def schedule_jobs(job_queue) -> None:
+    for job in job_queue.get_jobs_by_name("daily_sweep"):
+        job.schedule_removal()
+    now = datetime.now(TIMEZONE)
+    job_queue.run_repeating(
+        daily_sweep_job, interval=DAILY_SWEEP_INTERVAL, first=60 - now.second, name="daily_sweep"
+    )
+    for job in job_queue.get_jobs_by_name("cleanup"):
+        job.schedule_removal()
+    job_queue.run_repeating(cleanup_job, interval=CLEANUP_INTERVAL, first=CLEANUP_INTERVAL, name="cleanup")
+    for job in job_queue.get_jobs_by_name("retention"):
+        job.schedule_removal()
+    job_queue.run_daily(retention_job, time=time(hour=RETENTION_HOUR, minute=30, tzinfo=TIMEZONE), name="retention")
+    for job in job_queue.get_jobs_by_name("summary"):
+        job.schedule_removal()
+    if SUMMARY_TIME:
+        hour, minute = (int(x) for x in SUMMARY_TIME.split(":"))
+        job_queue.run_daily(summary_job, time=time(hour=hour, minute=minute, tzinfo=TIMEZONE), name="summary")
+    if METRICS_ENABLED:
+        from apscheduler.events import EVENT_JOB_SUBMITTED
+        job_queue.scheduler.add_listener(
+            functools.partial(_observe_job_lag, job_queue), EVENT_JOB_SUBMITTED
+        )
+        job_queue.run_repeating(metrics_log_job, interval=METRICS_LOG_INTERVAL, name="metrics_log")
+
+# ------------------ КОНКУРЕНТНОСТ ------------------
+# Ъпдейтите се обработват паралелно (CONCURRENT_UPDATES), но всичко, което променя списъка
+# на един Topic, минава през неговия asyncio.Lock – редът в рамките на Topic-а се запазва,
+# а бавен Bot API отговор в един офис не спира останалите.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+_TOPIC_LOCKS: Dict[str, asyncio.Lock] = {}
+
+def topic_lock(k: str) -> asyncio.Lock:
+    lock = _TOPIC_LOCKS.get(k)
+    if lock is None:
+        lock = _TOPIC_LOCKS[k] = asyncio.Lock()
+    return lock
+
+def update_topic_key(update: Update) -> Optional[str]:
+    msg = update.callback_query.message if update.callback_query else update.effective_message
+    if msg is None or update.effective_chat is None:
+        return None
+    return topic_key(update.effective_chat.id, getattr(msg, "message_thread_id", None))
+
+def per_topic(handler):
+    """Сериализира изпълнението на handler-а в рамките на един Topic."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        k = update_topic_key(update)
+        if k is None:
+            return await handler(update, context)
+        async with topic_lock(k):
+            return await handler(update, context)
+    return wrapper
+
+def spawn(context: ContextTypes.DEFAULT_TYPE, coro) -> None:
+    """Фонова задача, която Application изчаква при спиране."""
+    context.application.create_task(coro)
+
+# ------------------ HANDЛЕРИ ------------------
+SPLIT_MULTILINE = os.getenv("SPLIT_MULTILINE", "0") == "1"  # многоредово съобщение → артикул на ред
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(1024 * 1024)))
+
+@instrumented
+async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    msg = """Здравей! Ботът работи по Topics.
+Пусни /enable във ВСЕКИ офис-Topic, за да има отделен списък и дневно съобщение (по подразбиране в 10:00).
+
+Команди в текущия Topic:
+• /enable – включва дневното съобщение и списък за тази нишка
+• /disable – спира дневното съобщение за тази нишка
+• /time ЧЧ:ММ – сменя часа на дневното съобщение за тази нишка
+• /show – показва днешния списък за тази нишка
+• /clear – изчиства днешния списък за тази нишка
+• /find текст – търси в историята на чата (напр. /find iphone букса)
+• /export 2026-09 [2026-10] [csv|jsonl] [all] – историята на нишката (all – на целия чат) като файл
+• /summary – обща заявка от всички активни нишки на чата (/summary daily – всеки ден тук, /summary off – спира)
+• /edit – интерактивна редакция с бутони (Смени/Изтрий/Вмъкни/Премести)
+• Качете .txt/.csv файл – всеки ред става артикул в списъка на тази нишка.
+• Пишете артикул като текст – ще бъде изтрит и добавен към списъка на тази нишка (и ще се редактира „Днешният списък:“).
+"""
+    await send_in_topic(context, update.effective_chat.id, thread_id, msg)
+
+@instrumented
+async def enable_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if context.job_queue is None:
+        await send_in_topic(
+            context, update.effective_chat.id, getattr(update.effective_message, "message_thread_id", None),
+            "Нужно е да инсталираш python-telegram-bot[job-queue], за да работи дневното напомняне.")
+        return
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    k = topic_key(chat_id, thread_id)
+    enable_topic(chat_id, thread_id)
+    await ensure_list_message(context, chat_id, thread_id, k)
+    hour, minute = get_topic_time(k)
+    await send_in_topic(
+        context, chat_id, thread_id, f"Готово! Този Topic е активиран за {hour:02d}:{minute:02d} и има собствен списък."
+    )
+
+@instrumented
+async def disable_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    disable_topic(chat_id, thread_id)
+    await send_in_topic(context, chat_id, thread_id, "Този Topic е деактивиран за дневното съобщение.")
+
+@instrumented
+async def time_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/time [ЧЧ:ММ|default] – показва или сменя часа на дневното съобщение за Topic-а."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    k = topic_key(chat_id, thread_id)
+    if context.args:
+        arg = context.args[0].strip().lower()
+        if arg == "default":
+            set_topic_time(k, None)
+        else:
+            try:
+                parsed = datetime.strptime(arg, "%H:%M")
+            except ValueError:
+                await send_in_topic(context, chat_id, thread_id, "Формат: /time ЧЧ:ММ (напр. /time 09:30) или /time default")
+                return
+            set_topic_time(k, (parsed.hour, parsed.minute))
+    hour, minute = get_topic_time(k)
+    await send_in_topic(context, chat_id, thread_id, f"Дневното съобщение за този Topic е в {hour:02d}:{minute:02d}.")
+
+@instrumented
+async def show_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    k = topic_key(chat_id, thread_id)
+    await ensure_list_message(context, chat_id, thread_id, k)
+    await update_list_message(context, chat_id, thread_id, k)
+
+@instrumented
+async def summary_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/summary [daily|off] – обща заявка за деня или абонамент за автоматичния отчет."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "daily":
+        if not SUMMARY_TIME:
+            await send_in_topic(context, chat_id, thread_id, "Автоматичният отчет е изключен (SUMMARY_TIME).")
+            return
+        set_summary_topic(chat_id, topic_key(chat_id, thread_id))
+        await send_in_topic(context, chat_id, thread_id, f"Всеки ден в {SUMMARY_TIME} тук ще идва общата заявка.")
+        return
+    if arg == "off":
+        set_summary_topic(chat_id, None)
+        await send_in_topic(context, chat_id, thread_id, "Автоматичният отчет е спрян.")
+        return
+    for text in render_summary(chat_id):
+        await send_in_topic(context, chat_id, thread_id, text)
+
+@instrumented
+async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/find <текст> – най-новите артикули от историята на чата, съдържащи текста."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await send_in_topic(context, chat_id, thread_id, "Използване: /find текст (напр. /find iphone 15 pro букса)")
+        return
+    started = perf_counter()
+    await SEARCH.ensure_loaded()
+    results = await asyncio.to_thread(SEARCH.find, chat_id, query)
+    await send_in_topic(context, chat_id, thread_id, render_find(query, results, (perf_counter() - started) * 1000))
+
+EXPORT_USAGE = "Използване: /export ГГГГ-ММ[-ДД] [ГГГГ-ММ[-ДД]] [csv|jsonl] [all] (напр. /export 2026-09 csv)"
+
+@instrumented
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/export <от> [до] [csv|jsonl] [all] – историята на Topic-а (или целия чат) като файл."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    args = [a.lower() for a in context.args or []]
+    fmt = next((a for a in args if a in EXPORT_FORMATS), "csv")
+    whole_chat = "all" in args
+    dates = [a for a in args if a not in EXPORT_FORMATS and a != "all"]
+    if not 1 <= len(dates) <= 2:
+        await send_in_topic(context, chat_id, thread_id, EXPORT_USAGE)
+        return
+    try:
+        start, end = parse_export_range(*dates)
+    except ValueError as e:
+        await send_in_topic(context, chat_id, thread_id, f"{e}.\n{EXPORT_USAGE}")
+        return
+
+    k = None if whole_chat else topic_key(chat_id, thread_id)
+    started = perf_counter()
+    spool, count = await asyncio.to_thread(build_export_file, start, end, fmt, chat_id, k)
+    try:
+        size = spool.seek(0, io.SEEK_END)
+        logger.info("Export %s..%s %s for %s: %d rows, %d bytes in %.0f ms",
+                    start, end, fmt, k or chat_id, count, size, (perf_counter() - started) * 1000)
+        if not count:
+            await send_in_topic(context, chat_id, thread_id, f"Няма артикули между {start} и {end}.")
+            return
+        if size > EXPORT_MAX_BYTES:
+            await send_in_topic(context, chat_id, thread_id,
+                                f"Файлът е {size // (1024 * 1024)} MB – над лимита на Telegram. Избери по-кратък период.")
+            return
+        name = f"export_{'chat' if whole_chat else 'topic'}_{start}_{end}.{fmt}"
+        spool.seek(0)
+        # PTB така или иначе чете качвания файл целия (до EXPORT_MAX_BYTES)
+        await send_document_in_topic(context, chat_id, thread_id, spool.read(), name, f"{count} реда, {start} – {end}")
+    finally:
+        spool.close()
+
+def is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+@instrumented
+async def prune_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/prune [дни] – архивира историята извън прозореца (само за ADMIN_IDS)."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    if not is_admin(update):
+        await send_in_topic(context, chat_id, thread_id, "Командата е само за администратори (ADMIN_IDS).")
+        return
+    hot_days = HISTORY_HOT_DAYS
+    if context.args and context.args[0].isdigit():
+        hot_days = int(context.args[0])
+    report = await asyncio.to_thread(run_retention, hot_days)
+    await send_in_topic(context, chat_id, thread_id, format_retention_report(report))
+
+_PROFILE_LOCK = asyncio.Lock()
+
+@instrumented
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/profile [сек] – профил на event loop-а за кратък прозорец като файл (само за ADMIN_IDS)."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    if not is_admin(update):
+        await send_in_topic(context, chat_id, thread_id, "Командата е само за администратори (ADMIN_IDS).")
+        return
+    seconds = PROFILE_DEFAULT_SECONDS
+    if context.args:
+        if not context.args[0].isdigit():
+            await send_in_topic(context, chat_id, thread_id, f"Използване: /profile [секунди, до {PROFILE_MAX_SECONDS}]")
+            return
+        seconds = max(1, min(int(context.args[0]), PROFILE_MAX_SECONDS))
+    if _PROFILE_LOCK.locked():
+        await send_in_topic(context, chat_id, thread_id, "Вече тече профилиране – изчакай да свърши.")
+        return
+    async with _PROFILE_LOCK:
+        await send_in_topic(context, chat_id, thread_id, f"⏱ Профилирам {seconds} сек…")
+        try:
+            report = await profile_loop(seconds)
+        except ValueError as e:
+            await send_in_topic(context, chat_id, thread_id, f"Профилирането не може да започне: {e}")
+            return
+    name = f"profile_{datetime.now(TIMEZONE):%Y%m%d_%H%M%S}.txt"
+    await send_document_in_topic(context, chat_id, thread_id, report.encode("utf-8"), name, f"Профил за {seconds} сек.")
+
+@instrumented
+@per_topic
+async def clear_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+    k = topic_key(chat_id, thread_id)
+    clear_today(k)
+    await update_list_message(context, chat_id, thread_id, k)
+
+def split_item_lines(text: str) -> List[str]:
+    # Един артикул на ред; маха водещи "•", "-", "*" от поставени списъци
+    return [re.sub(r"^[•\-*]\s+", "", line.strip()) for line in text.splitlines() if line.strip()]
+
+def parse_import_file(raw: bytes, is_csv: bool) -> List[str]:
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            text = raw.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        text = raw.decode("utf-8", errors="replace")
+    if not is_csv:
+        return split_item_lines(text)
+    sniffer = csv.Sniffer()
+    try:
+        dialect = sniffer.sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = [[c.strip() for c in row] for row in csv.reader(io.StringIO(text), dialect)]
+    rows = [row for row in rows if any(row)]
+    if rows and tuple(c.lower() for c in rows[0]) == EXPORT_COLUMNS:
+        # Файл от /export: артикулът е само в колоната item
+        col = EXPORT_COLUMNS.index("item")
+        return [row[col] for row in rows[1:] if len(row) > col and row[col]]
+    try:
+        header = len(rows) > 1 and sniffer.has_header(text[:4096])
+    except csv.Error:
+        header = False
+    if header:
+        rows = rows[1:]
+    return [" – ".join(c for c in row if c) for row in rows]
+
+async def send_notice(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], text: str, ttl: float) -> None:
+    """Временно известие, което се изтрива след ttl секунди."""
+    try:
+        sent = await send_in_topic(context, chat_id, thread_id, text, PRIO_NOTICE)
+        schedule_delete(context, chat_id, sent.message_id, ttl)
+    except Exception as e:
+        logger.debug("Notice in %s failed: %s", chat_id, e)
+
+@instrumented
+@per_topic
+async def capture_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    msg = update.effective_message
+    chat = update.effective_chat
+    thread_id = getattr(msg, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+
+    # ❗ Обработваме текст САМО ако този Topic е активиран с /enable
+    if not is_topic_enabled(k):
+        return  # нищо не правим – без изтриване, без добавяне
+
+    text_in = (msg.text or "").strip()
+    if not text_in:
+        return
+
+    # Изтриването и известията вървят във фона – ключът на Topic-а се държи само за промяната
+    schedule_delete(context, chat.id, msg.message_id)
+
+    # Проверка дали чакаме текст за уизарда /edit (търсене или set/ins)
+    user_id = _wizard_user(update)
+    state = STATE.wizard(user_id, k)
+    if state and state.get("searching"):
+        await _apply_search(context, chat.id, thread_id, state, text_in)
+        return
+    if state and state.get("await") == "text":
+        mode = state.get("mode")
+        idx = state.get("index")
+        STATE.drop_wizard(user_id, k)
+        items = _current_items(k, state, [idx])
+        if items is None:
+            await send_in_topic(context, chat.id, thread_id, STALE_EDIT_TEXT)
+            return
+        changed = False
+        notice = None
+
+        if mode == "set":
+            if idx and 1 <= idx <= len(items):
+                items[idx - 1] = text_in
+                changed = True
+                notice = f"✅ Ред {idx} е обновен."
+        elif mode == "ins":
+            if idx and idx > len(state["items"]):
+                idx = len(items) + 1  # "накрая" остава накрая, дори списъкът да е пораснал
+            if idx and 1 <= idx <= len(items) + 1:
+                items.insert(idx - 1, text_in)
+                changed = True
+                notice = f"✅ Вмъкнато преди позиция {idx}."
+
+        if changed:
+            set_today_list(k, items)
+            request_list_update(context, chat.id, thread_id, k)
+            spawn(context, send_notice(context, chat.id, thread_id, notice or "Обнових списъка.", 5))
+        else:
+            await send_in_topic(context, chat.id, thread_id, "Невалидна позиция за редакция.")
+        return
+
+    # Обичайното поведение: артикул за добавяне (или по един на ред, ако SPLIT_MULTILINE=1)
+    if SPLIT_MULTILINE and "\n" in text_in:
+        added = append_items(k, split_item_lines(text_in))
+    else:
+        added = append_items(k, [text_in])
+    request_list_update(context, chat.id, thread_id, k)
+    notice = "Списъкът е обновен." if added == 1 else f"Списъкът е обновен (+{added})."
+    spawn(context, send_notice(context, chat.id, thread_id, notice, 3))
+
+@instrumented
+@per_topic
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Качен .txt/.csv файл в Topic-а → всички редове се добавят с един запис и една редакция."""
+    msg = update.effective_message
+    chat = update.effective_chat
+    thread_id = getattr(msg, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+    if not is_topic_enabled(k):
+        return
+    doc = msg.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await send_in_topic(context, chat.id, thread_id, f"Файлът е твърде голям (макс. {IMPORT_MAX_BYTES // 1024} KB).")
+        return
+    tg_file = await bot_call(context, "get_file", PRIO_DEFAULT, file_id=doc.file_id)
+    raw = bytes(await tg_file.download_as_bytearray())
+    items = parse_import_file(raw, (doc.file_name or "").lower().endswith(".csv"))
+    schedule_delete(context, chat.id, msg.message_id)
+    added = append_items(k, items)
+    request_list_update(context, chat.id, thread_id, k)
+    spawn(context, send_notice(context, chat.id, thread_id, f"Импортирани {added} артикула.", 5))
+
+# ---------- /edit уизард (бутони) ----------
+# Уизардът работи върху снимка на списъка от избора на действие и нейната версия. Бутоните
+# за избор на ред са на страници, а при дълъг списък "🔍 Търси" стеснява избора по част от
+# текста. Всеки бутон носи id на уизарда; ако списъкът е променен междувременно, промяната
+# се прилага само ако избраните позиции още сочат същите редове. Състоянието е в STATE
+# по (потребител, Topic), така че започната редакция оцелява рестарт.
+EDIT_PAGE_SIZE = 25        # бутони с номера (5 × 5)
+EDIT_MATCH_PAGE_SIZE = 8   # бутони с текст при търсене
+STALE_EDIT_TEXT = "⚠️ Списъкът е променен междувременно и редът вече не е на същото място. Пусни /edit отново."
+EXPIRED_EDIT_TEXT = "Тази редакция вече не е активна. Пусни /edit отново."
+_WIZARD_IDS = itertools.count(int(time_now()))  # уникални и след рестарт (уизардите се пазят в STATE)
+
+@instrumented
+async def edit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Стартира интерактивен уизард за редакция с бутони в текущия Topic."""
+    chat_id = update.effective_chat.id
+    thread_id = getattr(update.effective_message, "message_thread_id", None)
+
+    keyboard = [
+        [
+            InlineKeyboardButton("✏️ Смени", callback_data="edit_set"),
+            InlineKeyboardButton("🗑️ Изтрий", callback_data="edit_del"),
+        ],
+        [
+            InlineKeyboardButton("➕ Вмъкни", callback_data="edit_ins"),
+            InlineKeyboardButton("↔️ Премести", callback_data="edit_move"),
+        ],
+        [InlineKeyboardButton("❌ Откажи", callback_data="edit_cancel")],
+    ]
+    markup = InlineKeyboardMarkup(keyboard)
+
+    await send_in_topic(
+        context,
+        chat_id,
+        thread_id,
+        """Какво искаш да направиш със списъка?
+(Избери действие от бутоните)""",
+    )
+    await send_in_topic(
+        context, chat_id, thread_id, "Избери действие:", PRIO_ANSWER,
+        reply_markup=markup, reply_to_message_id=update.effective_message.message_id,
+    )
+
+
+def _short(text: str, limit: int = 40) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def _new_wizard(k: str, mode: str, items: List[str]) -> Dict:
+    """Състояние на уизарда: снимка на списъка + версия, върху които се строят клавиатурите."""
+    return {
+        "id": next(_WIZARD_IDS),
+        "mode": mode,
+        "await": "index",
+        "day": today_key(),
+        "version": list_version(k),
+        "items": items,
+        "count": len(items) + (1 if mode == "ins" else 0),
+        "matches": None,
+        "page": 0,
+    }
+
+def _index_keyboard(state: Dict) -> InlineKeyboardMarkup:
+    # Клавиатура за текущата стъпка: номера по 5 на ред или (при търсене) редове с текст,
+    # на страници с ◀️/▶️
+    wid = state["id"]
+    prefix = "pickto" if state["await"] == "toindex" else "pick"
+    matches = state["matches"]
+    candidates = matches if matches is not None else list(range(1, state["count"] + 1))
+    size = EDIT_MATCH_PAGE_SIZE if matches is not None else EDIT_PAGE_SIZE
+    pages = max(1, -(-len(candidates) // size))
+    page = state["page"] = min(max(0, state["page"]), pages - 1)
+
+    rows = []
+    row = []
+    for i in candidates[page * size:(page + 1) * size]:
+        if matches is not None:
+            rows.append([InlineKeyboardButton(f"{i}. {_short(state['items'][i - 1])}", callback_data=f"{prefix}_{wid}_{i}")])
+            continue
+        row.append(InlineKeyboardButton(str(i), callback_data=f"{prefix}_{wid}_{i}"))
+        if len(row) == 5:
+            rows.append(row)
+            row = []
+    if row:
+        rows.append(row)
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"editpg_{wid}_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"editpg_{wid}_{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"editpg_{wid}_{page + 1}"))
+        rows.append(nav)
+    last = []
+    if matches is not None:
+        last.append(InlineKeyboardButton("📋 Всички", callback_data=f"editall_{wid}"))
+    elif state["count"] > EDIT_PAGE_SIZE:
+        last.append(InlineKeyboardButton("🔍 Търси", callback_data=f"editfind_{wid}"))
+    last.append(InlineKeyboardButton("Откажи", callback_data="edit_cancel"))
+    rows.append(last)
+    return InlineKeyboardMarkup(rows)
+
+def _wizard_user(update: Update) -> int:
+    return update.effective_user.id if update.effective_user else 0
+
+def _wizard_for(user_id: int, k: str, wid: int) -> Optional[Dict]:
+    """Активното състояние, само ако бутонът е от същия уизард."""
+    state = STATE.wizard(user_id, k)
+    if state and state.get("id") == wid:
+        return state
+    return None
+
+def _current_items(k: str, state: Dict, positions: List[int]) -> Optional[List[str]]:
+    """Текущият списък за промяна или None, ако избраните позиции вече сочат други редове."""
+    if state["day"] != today_key():
+        return None
+    if state["version"] == list_version(k):
+        return list(state["items"])  # няма промени от снимката насам
+    items = get_today(k)
+    snapshot = state["items"]
+    for pos in positions:
+        if pos > len(snapshot):
+            continue  # "накрая" при вмъкване
+        if pos > len(items) or items[pos - 1] != snapshot[pos - 1]:
+            return None
+    return items
+
+async def _apply_search(context: ContextTypes.DEFAULT_TYPE, chat_id: int, thread_id: Optional[int], state: Dict,
+                        text: str) -> None:
+    """Стеснява кандидатите на уизарда до редовете, съдържащи text, и обновява клавиатурата."""
+    needle = text.casefold()
+    state["searching"] = False
+    state["matches"] = [i for i, item in enumerate(state["items"], 1) if needle in item.casefold()]
+    state["page"] = 0
+    if state["matches"]:
+        prompt = f"{state['prompt']}\n🔍 „{_short(text)}“ – съвпадения: {len(state['matches'])}"
+    else:
+        prompt = f"Няма редове с „{_short(text)}“."
+    markup = _index_keyboard(state)
+    try:
+        await bot_call(context, "edit_message_text", PRIO_ANSWER, chat_id=chat_id, message_id=state["msg"],
+                       text=prompt, reply_markup=markup)
+    except BadRequest:
+        sent = await send_in_topic(context, chat_id, thread_id, prompt, PRIO_ANSWER, reply_markup=markup)
+        state["msg"] = sent.message_id
+    STATE.mark()
+
+async def _show_step(context: ContextTypes.DEFAULT_TYPE, query, state: Dict, prompt: str) -> None:
+    state["prompt"] = prompt
+    state["msg"] = query.message.message_id
+    STATE.mark()
+    await edit_query_text(context, query, prompt, reply_markup=_index_keyboard(state))
+
+
+@instrumented
+@per_topic
+async def on_edit_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await answer_query(context, query)
+    data = query.data  # edit_set/del/ins/move/cancel
+
+    chat = query.message.chat
+    thread_id = getattr(query.message, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+
+    if data == "edit_cancel":
+        STATE.drop_wizard(_wizard_user(update), k)
+        await edit_query_text(context, query, "❌ Отказано.")
+        return
+
+    mode = data.split("_", 1)[1]  # set/del/ins/move
+    items = get_today(k)
+
+    if mode in ("set", "del", "move") and not items:
+        await edit_query_text(context, query, "Няма редове за редакция. Използвай ➕ Вмъкни.")
+        return
+
+    state = STATE.set_wizard(_wizard_user(update), k, _new_wizard(k, mode, items))
+
+    if mode == "set":
+        await _show_step(context, query, state, "Избери кой ред да сменя:")
+    elif mode == "del":
+        await _show_step(context, query, state, "Избери кой ред да изтрия:")
+    elif mode == "ins":
+        await _show_step(context, query, state, "Избери ПРЕД коя позиция да вмъкна (или последната за накрая):")
+    elif mode == "move":
+        await _show_step(context, query, state, "Избери кой ред да преместя:")
+
+
+@instrumented
+@per_topic
+async def on_edit_nav(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Страници (editpg_ID_P), търсене (editfind_ID) и връщане към всички редове (editall_ID)."""
+    query = update.callback_query
+    await answer_query(context, query)
+
+    action, wid, *rest = query.data.split("_")
+    chat = query.message.chat
+    thread_id = getattr(query.message, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+    state = _wizard_for(_wizard_user(update), k, int(wid))
+    if state is None:
+        await edit_query_text(context, query, EXPIRED_EDIT_TEXT)
+        return
+
+    if action == "editpg":
+        page = int(rest[0])
+        if page == state["page"]:
+            return
+        state["page"] = page
+    elif action == "editfind":
+        state["searching"] = True
+        state["msg"] = query.message.message_id
+        STATE.mark()
+        await edit_query_text(
+            context, query, "Изпрати част от текста на реда като съобщение.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Откажи", callback_data="edit_cancel")]]),
+        )
+        return
+    elif action == "editall":
+        state["matches"] = None
+        state["page"] = 0
+    STATE.mark()
+    await edit_query_text(context, query, state["prompt"], reply_markup=_index_keyboard(state))
+
+
+@instrumented
+@per_topic
+async def on_pick_index(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await answer_query(context, query)
+
+    _, wid, idx = query.data.split("_")  # pick_ID_N
+    idx = int(idx)
+    chat = query.message.chat
+    thread_id = getattr(query.message, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+
+    user_id = _wizard_user(update)
+    state = _wizard_for(user_id, k, int(wid))
+    if state is None:
+        await edit_query_text(context, query, EXPIRED_EDIT_TEXT)
+        return
+    mode = state.get("mode")
+    if not 1 <= idx <= state["count"]:
+        await edit_query_text(context, query, "Невалиден индекс.")
+        STATE.drop_wizard(user_id, k)
+        return
+
+    if mode == "del":
+        STATE.drop_wizard(user_id, k)
+        items = _current_items(k, state, [idx])
+        if items is None:
+            await edit_query_text(context, query, STALE_EDIT_TEXT)
+            return
+        removed = items.pop(idx - 1)
+        set_today_list(k, items)
+        request_list_update(context, chat.id, thread_id, k)
+        await edit_query_text(context, query, f"✅ Изтрих ред {idx}: {removed}")
+        return
+
+    if mode == "set":
+        state.update({"await": "text", "index": idx})
+        STATE.mark()
+        await edit_query_text(
+            context, query, f"Изпрати новия текст за ред {idx} ({_short(state['items'][idx - 1])}) като съобщение."
+        )
+        return
+
+    if mode == "ins":
+        state.update({"await": "text", "index": idx})
+        STATE.mark()
+        await edit_query_text(context, query,
+            f"Изпрати текст за вмъкване ПРЕДИ позиция {idx} (или последна за накрая)."
+        )
+        return
+
+    if mode == "move":
+        state.update({"await": "toindex", "from": idx, "count": len(state["items"]), "matches": None, "page": 0})
+        await _show_step(context, query, state, f"Избери НОВА позиция за ред {idx} ({_short(state['items'][idx - 1])}):")
+        return
+
+    await edit_query_text(context, query, "Неподдържано действие.")
+
+
+@instrumented
+@per_topic
+async def on_pick_to_index(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await answer_query(context, query)
+
+    _, wid, dst = query.data.split("_")  # pickto_ID_N
+    dst = int(dst)
+    chat = query.message.chat
+    thread_id = getattr(query.message, "message_thread_id", None)
+    k = topic_key(chat.id, thread_id)
+
+    user_id = _wizard_user(update)
+    state = _wizard_for(user_id, k, int(wid))
+    if state is None or state.get("await") != "toindex":
+        await edit_query_text(context, query, EXPIRED_EDIT_TEXT)
+        return
+    STATE.drop_wizard(user_id, k)
+    src = state.get("from")
+    snapshot = state["items"]
+
+    if not src or not (1 <= src <= len(snapshot)) or not (1 <= dst <= len(snapshot)):
+        await edit_query_text(context, query, "Невалидни позиции.")
+        return
+
+    if src == dst:
+        await edit_query_text(context, query, "Позициите съвпадат – няма промяна.")
+        return
+
+    items = _current_items(k, state, [src, dst])
+    if items is None:
+        await edit_query_text(context, query, STALE_EDIT_TEXT)
+        return
+    itm = items.pop(src - 1)
+    items.insert(dst - 1, itm)
+    set_today_list(k, items)
+    request_list_update(context, chat.id, thread_id, k)
+
+    await edit_query_text(context, query, f"✅ Преместих ред {src} → {dst}.")
+
+# ------------------ WEBHOOK ------------------
+# BOT_MODE=webhook: вместо long polling ботът слуша на WEBHOOK_LISTEN:WEBHOOK_PORT с вграден
+# async HTTP сървър. Telegram праща всеки ъпдейт с хедър X-Telegram-Bot-Api-Secret-Token,
+# който трябва да съвпада с WEBHOOK_SECRET (задължителен, щом WEBHOOK_URL е зададен – иначе
+# всеки, знаещ адреса, може да праща ъпдейти от името на Telegram). При спиране сървърът спира да приема, изчаква
+# текущите заявки и чак тогава Application обработва останалото в опашката.
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()  # публичен https адрес; празно → без setWebhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+HTTP_MAX_BODY = 1024 * 1024
+# Портът е публичен: бавен или безкраен клиент не бива да държи връзка и памет вечно
+HTTP_MAX_LINE = 8 * 1024      # ред от заявката или хедър
+HTTP_MAX_HEADERS = 64
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))  # сек. за глава + тяло на заявка
+HTTP_IDLE_TIMEOUT = float(os.getenv("HTTP_IDLE_TIMEOUT", "30"))  # сек. keep-alive без нова заявка
+
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                 408: "Request Timeout", 413: "Payload Too Large", 421: "Misdirected Request", 500: "Internal Server Error",
+                 502: "Bad Gateway", 503: "Service Unavailable"}
+
+HttpResponse = Tuple[int, str, bytes]  # (статус, content-type, тяло)
+
+class HttpServer:
+    """Минимален HTTP/1.1 сървър (keep-alive, Content-Length) върху asyncio.start_server."""
+
+    def __init__(self, host: str, port: int, routes: Dict[Tuple[str, str], Callable[[Dict], Awaitable[HttpResponse]]]):
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closing = False
+        self._writers: set = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=HTTP_MAX_LINE)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Спира приемането на връзки и изчаква започнатите заявки (до timeout)."""
+        self._closing = True
+        if self._server is not None:
+            self._server.close()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("HTTP server closed with %d requests still running", self._active)
+        for writer in list(self._writers):
+            writer.close()
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Dict]:
+        # Празна keep-alive връзка се затваря след HTTP_IDLE_TIMEOUT; започнатата заявка
+        # трябва да пристигне цялата за HTTP_READ_TIMEOUT (иначе 408)
+        try:
+            line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        if not line:
+            return None
+        return await asyncio.wait_for(self._read_rest(reader, line), HTTP_READ_TIMEOUT)
+
+    async def _read_rest(self, reader: asyncio.StreamReader, line: bytes) -> Dict:
+        # Ред над HTTP_MAX_LINE → ValueError от readline (limit на start_server)
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        for count in itertools.count():
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if count >= HTTP_MAX_HEADERS:
+                raise ValueError("too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length < 0 or length > HTTP_MAX_BODY:
+            raise ValueError("bad content-length")
+        body = await reader.readexactly(length) if length else b""
+        path, _, query = target.partition("?")
+        return {"method": method.upper(), "path": path, "query": query, "headers": headers, "body": body}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            while not self._closing:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    await self._respond(writer, (400, "text/plain", b"bad request"), close=True)
+                    break
+                except asyncio.TimeoutError:
+                    await self._respond(writer, (408, "text/plain", b"request timeout"), close=True)
+                    break
+                if request is None:
+                    break
+                self._active += 1
+                self._idle.clear()
+                try:
+                    response = await self._dispatch(request)
+                finally:
+                    self._active -= 1
+                    if not self._active:
+                        self._idle.set()
+                close = self._closing or request["headers"].get("connection", "").lower() == "close"
+                await self._respond(writer, response, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, request: Dict) -> HttpResponse:
+        route = self.routes.get((request["method"], request["path"]))
+        if route is None:
+            # Маршрути, завършващи на "*", покриват всички пътища с този префикс
+            route = next((r for (m, p), r in self.routes.items()
+                          if m == request["method"] and p.endswith("*") and request["path"].startswith(p[:-1])), None)
+        if route is None:
+            known = any(p == request["path"] or (p.endswith("*") and request["path"].startswith(p[:-1]))
+                        for _, p in self.routes)
+            return (405, "text/plain", b"method not allowed") if known else (404, "text/plain", b"not found")
+        try:
+            return await route(request)
+        except Exception:
+            logger.exception("HTTP handler for %s failed", request["path"])
+            return 500, "text/plain", b"internal error"
+
+    async def _respond(self, writer: asyncio.StreamWriter, response: HttpResponse, close: bool) -> None:
+        status, content_type, body = response
+        head = (
+            f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await asyncio.wait_for(writer.drain(), HTTP_READ_TIMEOUT)  # клиент, който не чете
+
+def parse_update_body(body: bytes) -> Dict:
+    """Тялото на webhook заявка като ъпдейт; ValueError, ако не е JSON обект с update_id."""
+    raw = json.loads(body)
+    if not isinstance(raw, dict) or not isinstance(raw.get("update_id"), int):
+        raise ValueError("not an update")
+    return raw
+
+def webhook_routes(app: Application) -> Dict:
+    async def receive_update(request: Dict) -> HttpResponse:
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request["headers"].get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+        ):
+            return 403, "text/plain", b"forbidden"
+        if not app.running:
+            return 503, "text/plain", b"stopping"
+        try:
+            raw = parse_update_body(request["body"])
+            if SHARD_COUNT > 1 and shard_for(update_chat_id(raw), SHARD_COUNT) != SHARD_INDEX:
+                return 421, "text/plain", b"wrong shard"
+            update = Update.de_json(raw, app.bot)
+        except (ValueError, AttributeError, TypeError, KeyError):
+            return 400, "text/plain", b"invalid update"
+        await app.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    async def health(request: Dict) -> HttpResponse:
+        return 200, "text/plain", b"ok"
+
+    routes = {("POST", WEBHOOK_PATH): receive_update, ("GET", "/healthz"): health}
+    if METRICS_ENABLED:
+        routes.update(metrics_routes())
+    return routes
+
+def metrics_routes() -> Dict:
+    async def metrics(request: Dict) -> HttpResponse:
+        return 200, "text/plain; version=0.0.4", METRICS.render().encode("utf-8")
+    return {("GET", "/metrics"): metrics}
+
+_METRICS_SERVER: Optional[HttpServer] = None
+
+async def start_metrics_server() -> None:
+    """Отделен /metrics сървър за polling режим (в webhook режим е на същия порт)."""
+    global _METRICS_SERVER
+    _METRICS_SERVER = HttpServer(WEBHOOK_LISTEN, METRICS_PORT, metrics_routes())
+    await _METRICS_SERVER.start()
+    logger.info("Metrics on %s:%d/metrics", WEBHOOK_LISTEN, _METRICS_SERVER.port)
+
+async def serve_webhook(app: Application) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):  # Windows
+            pass
+
+    await app.initialize()
+    await on_start(app)
+    await app.start()
+    server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT, webhook_routes(app))
+    await server.start()
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info("Webhook server listening on %s:%d%s", WEBHOOK_LISTEN, server.port, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Draining webhook server…")
+        await server.close()
+        await app.stop()  # обработва всичко, което вече е в update_queue
+        await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+# ------------------ ШАРДОВЕ ------------------
+# `run --shards N` пуска координатор и N работни процеса. Координаторът е webhook входът:
+# разпределя всеки ъпдейт по crc32(chat_id) % N и го препраща към своя работник. Всеки
+# работник е обикновен бот в webhook режим на 127.0.0.1:SHARD_BASE_PORT+i със собствено
+# хранилище, архив и дневни задачи – само за своите чатове. Ако работник падне, координаторът
+# го рестартира; междувременно Telegram получава 502 и праща ъпдейта пак.
+#
+# Файловете на шард i от N са order_data.s{i}of{N}.json / .db, bot_state.s{i}of{N}.json и
+# archive/s{i}of{N}/ (при N=1 – обичайните). Текущият брой е в SHARDS_FILE; при старт с друг брой координаторът първо
+# преразпределя данните: пише новите файлове, сменя SHARDS_FILE и чак тогава преименува
+# старите на *.bak – срив по средата оставя старото разпределение в сила.
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARDS_FILE = os.getenv("SHARDS_FILE", "shards.json")
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", str(WEBHOOK_PORT + 1)))
+SHARD_START_TIMEOUT = float(os.getenv("SHARD_START_TIMEOUT", "30"))
+
+def shard_for(chat_id: int, count: int) -> int:
+    return zlib.crc32(str(chat_id).encode("ascii")) % count
+
+def update_chat_id(raw: Dict) -> int:
+    """chat_id на ъпдейт (суров JSON); за ъпдейти без чат – id на потребителя, иначе 0."""
+    for value in raw.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return int(chat["id"])
+        if value.get("from"):
+            return int(value["from"]["id"])
+    return 0
+
+def _key_chat(key: str) -> Optional[int]:
+    # "chat#thread" или "chat" → chat_id; друго (напр. "imported_from") → None
+    head = str(key).split(SEP, 1)[0]
+    return int(head) if head.lstrip("-").isdigit() else None
+
+def shard_files(index: int, count: int) -> Dict[str, str]:
+    if count <= 1:
+        return {"data": DATA_FILE, "db": DB_FILE, "archive": ARCHIVE_DIR, "state": STATE_FILE}
+    suffix = f".s{index}of{count}"
+    data_root, data_ext = os.path.splitext(DATA_FILE)
+    db_root, db_ext = os.path.splitext(DB_FILE)
+    state_root, state_ext = os.path.splitext(STATE_FILE)
+    return {
+        "data": data_root + suffix + data_ext,
+        "db": db_root + suffix + db_ext,
+        "archive": os.path.join(ARCHIVE_DIR, suffix[1:]),
+        "state": state_root + suffix + state_ext,
+    }
+
+def read_shard_count() -> int:
+    try:
+        with open(SHARDS_FILE, "r", encoding="utf-8") as f:
+            return int(json.load(f)["count"])
+    except FileNotFoundError:
+        return 1
+
+def _write_shard_count(count: int) -> None:
+    tmp = SHARDS_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"count": count}, f)
+    os.replace(tmp, SHARDS_FILE)
+
+def split_data(data: Dict, count: int) -> List[Dict]:
+    """Разделя съдържанието на хранилище по шардове. Meta речници с ключове Topic/чат се
+    разделят по ключ; всичко останало отива в шард 0."""
+    parts = [_empty_data() for _ in range(count)]
+    for part in parts:
+        part["meta"] = {}
+    for k in data.get("enabled_topics", []):
+        parts[shard_for(_key_chat(k), count)]["enabled_topics"].append(k)
+    for section in ("lists", "list_msgs"):
+        for k, days in data.get(section, {}).items():
+            parts[shard_for(_key_chat(k), count)][section][k] = days
+    for key, value in (data.get("meta") or {}).items():
+        if isinstance(value, dict) and value and all(_key_chat(x) is not None for x in value):
+            for x, v in value.items():
+                parts[shard_for(_key_chat(x), count)]["meta"].setdefault(key, {})[x] = v
+        else:
+            parts[0]["meta"][key] = value
+    return parts
+
+def _storage_paths(files: Dict[str, str]) -> List[str]:
+    data, db = files["data"], files["db"]
+    return [data, data + ".journal", data + ".tmp", db, db + "-wal", db + "-shm", files["state"]]
+
+def _read_state_file(path: str) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def rebalance_shards(count: int) -> Optional[Dict[str, int]]:
+    """Преразпределя хранилищата и архивите от текущия брой шардове към count.
+    Синхронна; викай я само докато работниците са спрени. None → нищо за правене."""
+    old_count = read_shard_count()
+    if old_count == count:
+        return None
+    started = monotonic()
+    old = [shard_files(i, old_count) for i in range(old_count)]
+    new = [shard_files(i, count) for i in range(count)]
+
+    merged = _empty_data()
+    for files in old:
+        storage = open_storage(files["data"], files["db"])
+        try:
+            _merge_data(merged, storage.export_data())
+        finally:
+            storage.close()
+        # Отложените изтривания пътуват с meta и се разделят по чат като нея; новите
+        # стартови снимки се строят наново от хранилищата (започнатите /edit се губят)
+        pending = _read_state_file(files["state"]).get("pending_deletes") or {}
+        for chat_id, entries in pending.items():
+            merged.setdefault("meta", {}).setdefault("pending_deletes", {}).setdefault(chat_id, []).extend(entries)
+    # Остатъци от прекъснато преразпределение към същия брой
+    for files in new:
+        for path in _storage_paths(files):
+            if os.path.exists(path):
+                os.remove(path)
+        for month in archive_months(files["archive"]):
+            os.remove(archive_path(month, files["archive"]))
+
+    items = 0
+    for files, part in zip(new, split_data(merged, count)):
+        storage = open_storage(files["data"], files["db"])
+        try:
+            items += storage.import_data(part, source=f"rebalance {old_count}->{count}")
+        finally:
+            storage.close()
+    months = sorted({m for files in old for m in archive_months(files["archive"])})
+    for month in months:
+        lists: Dict[str, Dict[str, List[str]]] = {}
+        for files in old:
+            for k, days in read_archive_month(month, files["archive"]).items():
+                lists.setdefault(k, {}).update(days)
+        by_shard: Dict[int, Dict[str, Dict[str, List[str]]]] = {}
+        for k, days in lists.items():
+            by_shard.setdefault(shard_for(_key_chat(k), count), {})[k] = days
+        for i, part in by_shard.items():
+            _write_archive_month(month, part, new[i]["archive"])
+
+    _write_shard_count(count)
+    # Новото разпределение е в сила – старите файлове остават като *.bak
+    for files in old:
+        for path in _storage_paths(files):
+            if os.path.exists(path):
+                os.replace(path, path + ".bak")
+        for month in months:
+            path = archive_path(month, files["archive"])
+            if os.path.exists(path):
+                os.replace(path, path + ".bak")
+    report = {"from": old_count, "to": count, "topics": len(merged["lists"]), "items": items,
+              "archive_months": len(months), "ms": int((monotonic() - started) * 1000)}
+    logger.info("Rebalanced shards: %s", report)
+    return report
+
+class ShardCoordinator:
+    """Webhook вход + надзор на работниците. Работниците слушат само на 127.0.0.1 и
+    приемат ъпдейти с вътрешен секрет, различен от WEBHOOK_SECRET."""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.secret = secrets.token_urlsafe(24)
+        self.procs: List[Optional[asyncio.subprocess.Process]] = [None] * count
+        self.urls = [f"http://127.0.0.1:{SHARD_BASE_PORT + i}{WEBHOOK_PATH}" for i in range(count)]
+        self.forwarded = [0] * count
+        self._stopping = False
+        self._client = None
+
+    def worker_env(self, index: int) -> Dict[str, str]:
+        files = shard_files(index, self.count)
+        env = dict(os.environ)
+        env.update({
+            "BOT_MODE": "webhook",
+            "WEBHOOK_URL": "",  # setWebhook прави само координаторът
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": str(SHARD_BASE_PORT + index),
+            "WEBHOOK_SECRET": self.secret,
+            "SHARD_INDEX": str(index),
+            "SHARD_COUNT": str(self.count),
+            "DATA_FILE": files["data"],
+            "DB_FILE": files["db"],
+            "ARCHIVE_DIR": files["archive"],
+            "STATE_FILE": files["state"],
+            # Общият лимит на Telegram е за целия бот – делим го между работниците
+            "API_GLOBAL_RATE": str(API_GLOBAL_RATE / self.count),
+        })
+        return env
+
+    async def start_worker(self, index: int) -> None:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "run", env=self.worker_env(index)
+        )
+        self.procs[index] = proc
+        health = f"http://127.0.0.1:{SHARD_BASE_PORT + index}/healthz"
+        deadline = monotonic() + SHARD_START_TIMEOUT
+        while monotonic() < deadline:
+            if proc.returncode is not None:
+                raise RuntimeError(f"Шард {index} спря при старт (код {proc.returncode}).")
+            try:
+                if (await self._client.get(health)).status_code == 200:
+                    logger.info("Shard %d/%d up (pid %d)", index, self.count, proc.pid)
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError(f"Шард {index} не отговори за {SHARD_START_TIMEOUT:g} сек.")
+
+    async def supervise(self, index: int) -> None:
+        while not self._stopping:
+            code = await self.procs[index].wait()
+            if self._stopping:
+                return
+            logger.error("Shard %d exited with code %s, restarting", index, code)
+            await asyncio.sleep(1.0)
+            try:
+                await self.start_worker(index)
+            except RuntimeError:
+                logger.exception("Shard %d restart failed", index)
+
+    def routes(self) -> Dict:
+        async def receive_update(request: Dict) -> HttpResponse:
+            if WEBHOOK_SECRET and not hmac.compare_digest(
+                request["headers"].get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET
+            ):
+                return 403, "text/plain", b"forbidden"
+            if self._stopping:
+                return 503, "text/plain", b"stopping"
+            try:
+                index = shard_for(update_chat_id(parse_update_body(request["body"])), self.count)
+            except (ValueError, AttributeError, TypeError, KeyError):
+                return 400, "text/plain", b"invalid update"
+            try:
+                resp = await self._client.post(self.urls[index], content=request["body"], headers={
+                    "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": self.secret,
+                })
+            except httpx.HTTPError as e:
+                logger.warning("Forward to shard %d failed: %s", index, e)
+                return 502, "text/plain", b"shard unavailable"
+            self.forwarded[index] += 1
+            return resp.status_code, "text/plain", resp.content
+
+        async def health(request: Dict) -> HttpResponse:
+            alive = all(p is not None and p.returncode is None for p in self.procs)
+            return (200, "text/plain", b"ok") if alive else (503, "text/plain", b"shard down")
+
+        async def status(request: Dict) -> HttpResponse:
+            body = [{"shard": i, "pid": p.pid if p else None, "running": bool(p and p.returncode is None),
+                     "forwarded": self.forwarded[i]} for i, p in enumerate(self.procs)]
+            return 200, "application/json", json.dumps(body).encode("utf-8")
+
+        return {("POST", WEBHOOK_PATH): receive_update, ("GET", "/healthz"): health, ("GET", "/_shards"): status}
+
+    async def run(self) -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):  # Windows
+                pass
+
+        report = await asyncio.to_thread(rebalance_shards, self.count)
+        if report:
+            print(f"Преразпределени {report['items']} артикула: {report['from']} → {report['to']} шарда.")
+        self._client = httpx.AsyncClient(timeout=30.0)
+        server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT, self.routes())
+        supervisors = []
+        try:
+            await asyncio.gather(*(self.start_worker(i) for i in range(self.count)))
+            supervisors = [asyncio.create_task(self.supervise(i)) for i in range(self.count)]
+            await server.start()
+            if WEBHOOK_URL:
+                await set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH)
+            logger.info("Shard router listening on %s:%d%s (%d shards)",
+                        WEBHOOK_LISTEN, server.port, WEBHOOK_PATH, self.count)
+            await stop.wait()
+        finally:
+            logger.info("Stopping shard router…")
+            await server.close()
+            self._stopping = True
+            for task in supervisors:
+                task.cancel()
+            await self.stop_workers()
+            await self._client.aclose()
+
+    async def stop_workers(self, timeout: float = 30.0) -> None:
+        running = [p for p in self.procs if p is not None and p.returncode is None]
+        for proc in running:
+            proc.terminate()  # работникът дообработва опашката си и затваря хранилището
+        for proc in running:
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Shard pid %d did not stop in %gs, killing", proc.pid, timeout)
+                proc.kill()
+                await proc.wait()
+
+async def set_webhook(url: str) -> None:
+    kwargs = {}
+    if BOT_API_URL:
+        kwargs = {"base_url": f"{BOT_API_URL.rstrip('/')}/bot", "base_file_url": f"{BOT_API_URL.rstrip('/')}/file/bot"}
+    async with Bot(TOKEN, **kwargs) as bot:
+        await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET or None, allowed_updates=Update.ALL_TYPES)
+
+# ------------------ MAIN ------------------
+async def on_start(app: Application) -> None:
+    start_warm_up()
+    LOOP_MONITOR.start()
+    if METRICS_ENABLED and METRICS_PORT and BOT_MODE == "polling":
+        await start_metrics_server()
+
+async def on_stop(app: Application) -> None:
+    global _METRICS_SERVER
+    LOOP_MONITOR.stop()
+    if _METRICS_SERVER is not None:
+        await _METRICS_SERVER.close(timeout=1.0)
+        _METRICS_SERVER = None
+    await API.stop()
+
+async def on_shutdown(app: Application) -> None:
+    if _pending_deletes_dirty:
+        _save_pending_deletes()
+    STATE.close()
+    close_storage()
+
+def build_application(token: str, webhook: bool = False, api_url: str = BOT_API_URL) -> Application:
+    builder = (
+        Application.builder().token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_start)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if api_url:
+        # Собствен Bot API сървър (напр. fake_bot_api.py за бенчмарки)
+        builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+    if webhook:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    start_storage()
+    STATE.load()
+    load_pending_deletes()
+    if app.job_queue is not None:
+        schedule_jobs(app.job_queue)
+
+    app.add_handler(CommandHandler("start", start_cmd))
+    app.add_handler(CommandHandler("enable", enable_cmd))
+    app.add_handler(CommandHandler("disable", disable_cmd))
+    app.add_handler(CommandHandler("time", time_cmd))
+    app.add_handler(CommandHandler("show", show_cmd))
+    app.add_handler(CommandHandler("clear", clear_cmd))
+    app.add_handler(CommandHandler("summary", summary_cmd))
+    app.add_handler(CommandHandler("find", find_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("prune", prune_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
+    app.add_handler(CommandHandler("edit", edit_cmd))
+
+    app.add_handler(CallbackQueryHandler(on_edit_action, pattern=r"^edit_(set|del|ins|move|cancel)$"))
+    app.add_handler(CallbackQueryHandler(on_edit_nav, pattern=r"^edit(pg_[0-9]+_[0-9]+|find_[0-9]+|all_[0-9]+)$"))
+    app.add_handler(CallbackQueryHandler(on_pick_index, pattern=r"^pick_([0-9]+)_([0-9]+)$"))
+    app.add_handler(CallbackQueryHandler(on_pick_to_index, pattern=r"^pickto_([0-9]+)_([0-9]+)$"))
+
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, capture_text))
+    app.add_handler(MessageHandler(
+        filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"), import_document
+    ))
+    return app
+
+def run_bot(shards: int = 0) -> None:
+    if not TOKEN or TOKEN == "PUT_YOUR_TELEGRAM_BOT_TOKEN_HERE":
+        raise RuntimeError("Моля, постави валиден TOKEN в променливата TOKEN в кода.")
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if not shards and SHARD_COUNT <= 1 and read_shard_count() != 1:
+        # След run --shards N данните са в шардовете, а общите файлове са *.bak
+        raise RuntimeError(
+            f"Данните са разпределени в {read_shard_count()} шарда ({SHARDS_FILE}). Стартирай с "
+            f"run --shards {read_shard_count()} или ги събери обратно с rebalance --shards 1."
+        )
+    if (shards or BOT_MODE == "webhook") and WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL е зададен без WEBHOOK_SECRET – публичният webhook би приемал "
+                           "ъпдейти от всеки. Задай WEBHOOK_SECRET (A-Z, a-z, 0-9, _ и -, до 256 знака).")
+    if shards:
+        if BOT_MODE != "webhook":
+            raise RuntimeError("--shards работи само с BOT_MODE=webhook (координаторът е webhook входът).")
+        print(f"Bot is running ({shards} shards, webhook on port {WEBHOOK_PORT})… Press Ctrl+C to stop.")
+        asyncio.run(ShardCoordinator(shards).run())
+        return
+    if BOT_MODE == "webhook":
+        app = build_application(TOKEN, webhook=True)
+        print(f"Bot is running (webhook on port {WEBHOOK_PORT})… Press Ctrl+C to stop.")
+        asyncio.run(serve_webhook(app))
+        return
+    if BOT_MODE != "polling":
+        raise RuntimeError(f"Непознат BOT_MODE={BOT_MODE!r} (очаква се polling или webhook).")
+    app = build_application(TOKEN)
+    print("Bot is running… Press Ctrl+C to stop.")
+    app.run_polling(close_loop=False)
+
+def import_json_cli(args: argparse.Namespace) -> None:
+    storage = SqliteStorage(args.db)
+    try:
+        n = import_json_file(args.path, storage)
+    finally:
+        storage.close()
+    print(f"Импортирани {n} артикула от {args.path} в {args.db}.")
+
+def prune_cli(args: argparse.Namespace) -> None:
+    try:
+        print(format_retention_report(run_retention(args.days)))
+    finally:
+        close_storage()
+
+def export_cli(args: argparse.Namespace) -> None:
+    start, end = parse_export_range(args.start, args.end)
+    k = topic_key(args.chat, args.topic) if args.chat is not None and args.topic is not None else None
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        count = write_export(iter_export_rows(start, end, args.chat, k), out, args.format)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        close_storage()
+    print(f"Експортирани {count} реда ({start} – {end}).", file=sys.stderr)
+
+def rebalance_cli(args: argparse.Namespace) -> None:
+    report = rebalance_shards(args.shards)
+    if report is None:
+        print(f"Данните вече са разпределени в {args.shards} шарда.")
+        return
+    print(f"Преразпределени {report['items']} артикула в {report['topics']} Topics "
+          f"({report['archive_months']} архивни месеца): {report['from']} → {report['to']} шарда.")
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Telegram бот за дневни списъци по Topic.")
+    sub = parser.add_subparsers(dest="command")
+    p_run = sub.add_parser("run", help="стартира бота (по подразбиране)")
+    p_run.add_argument("--shards", type=int, default=0, help="брой работни процеса (webhook режим)")
+    p_imp = sub.add_parser("import-json", help="еднократен импорт на order_data.json в SQLite")
+    p_imp.add_argument("path", nargs="?", default=DATA_FILE)
+    p_imp.add_argument("--db", default=DB_FILE)
+    p_prune = sub.add_parser("prune", help="архивира историята по-стара от --days дни")
+    p_prune.add_argument("--days", type=int, default=HISTORY_HOT_DAYS)
+    p_exp = sub.add_parser(
+        "export", help="експорт на историята за период като CSV/JSONL",
+        description="Експорт на историята за период като CSV/JSONL. Архивът и SQLite се четат поточно; "
+                    "със STORAGE=json цялото order_data.json (+ журнала) се зарежда в паметта – "
+                    "за многогодишна история без архив ползвай STORAGE=sqlite.",
+    )
+    p_exp.add_argument("--from", dest="start", required=True, help="ГГГГ-ММ-ДД или ГГГГ-ММ")
+    p_exp.add_argument("--to", dest="end", help="ГГГГ-ММ-ДД или ГГГГ-ММ (по подразбиране = --from)")
+    p_exp.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    p_exp.add_argument("--chat", type=int, help="само този чат")
+    p_exp.add_argument("--topic", type=int, help="само този Topic (0 – общ чат; изисква --chat)")
+    p_exp.add_argument("-o", "--output", default="-", help="файл (по подразбиране stdout)")
+    p_reb = sub.add_parser("rebalance", help="преразпределя данните между --shards шарда (ботът трябва да е спрян)")
+    p_reb.add_argument("--shards", type=int, required=True)
+    args = parser.parse_args(argv)
+    if getattr(args, "shards", 0) < 0 or (args.command == "rebalance" and args.shards < 1):
+        parser.error("--shards трябва да е положително число")
+
+    if args.command == "import-json":
+        import_json_cli(args)
+        return
+    if args.command == "prune":
+        prune_cli(args)
+        return
+    if args.command == "export":
+        if args.topic is not None and args.chat is None:
+            parser.error("--topic изисква --chat")
+        try:
+            parse_export_range(args.start, args.end)
+        except ValueError as e:
+            parser.error(str(e))
+        export_cli(args)
+        return
+    if args.command == "rebalance":
+        rebalance_cli(args)
+        return
+    run_bot(getattr(args, "shards", 0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+# bench_bot.py
+# Бенчмарки на бота срещу локалния fake_bot_api.py (без истински Telegram).
+# Всеки сценарий върви в отделен процес с празна работна папка, за да не си пречат.
+#
+#   python bench_bot.py                       # всички сценарии
+#   python bench_bot.py burst fanout --storage sqlite
+#   python bench_bot.py fanout --topics 500 --latency 0.05 --retry-after-every 40
+#   python bench_bot.py shards --shards 4 --chats 40
+#   python bench_bot.py startup --topics 400
+#
+# Отчита: ъпдейти/сек, p50/p99 латентност на handler-а, Bot API извиквания на ъпдейт и
+# записани байтове на диска.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:BENCH"
+CHAT_ID = -1001234567890
+USER = {"id": 42, "is_bot": False, "first_name": "Bench"}
+
+SCENARIOS = ["burst", "parallel", "edit", "fanout", "history", "shards", "startup"]
+
+# ------------------ UPDATE-и ------------------
+_update_ids = iter(range(1, 10 ** 9))
+_message_ids = iter(range(1, 10 ** 9))
+
+def _message(thread_id: int, text: str, command: bool = False, chat_id: int = CHAT_ID) -> Dict:
+    msg = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "is_forum": True},
+        "from": USER,
+        "text": text,
+    }
+    if thread_id:
+        msg["message_thread_id"] = thread_id
+        msg["is_topic_message"] = True
+    if command:
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return msg
+
+def text_update(thread_id: int, text: str, chat_id: int = CHAT_ID) -> Dict:
+    return {"update_id": next(_update_ids), "message": _message(thread_id, text, chat_id=chat_id)}
+
+def command_update(thread_id: int, text: str, chat_id: int = CHAT_ID) -> Dict:
+    return {"update_id": next(_update_ids), "message": _message(thread_id, text, command=True, chat_id=chat_id)}
+
+def callback_update(thread_id: int, data: str) -> Dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": USER,
+            "chat_instance": "bench",
+            "data": data,
+            "message": _message(thread_id, "Избери:"),
+        },
+    }
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# ------------------ СЦЕНАРИИ (в дъщерен процес) ------------------
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        import advancing_query_bot as bot
+        from telegram.ext import CallbackContext
+        self.bot = bot
+        self.args = args
+        self.app = bot.build_application(TOKEN, api_url=args.api)
+        self.context = CallbackContext(self.app)
+        self.latencies: List[float] = []
+        self.updates = 0
+
+    async def api(self, method: str, path: str, payload: Optional[Dict] = None) -> Dict:
+        import httpx
+        async with httpx.AsyncClient() as client:
+            r = await client.request(method, self.args.api + path, json=payload)
+            return r.json()
+
+    async def start(self) -> None:
+        if self.bot.STORAGE == "sqlite":
+            # Без автоматичен checkpoint WAL файлът расте с всяка записана страница
+            self.bot.get_storage()._db.execute("PRAGMA wal_autocheckpoint=0")
+        await self.app.initialize()
+        await self.app.start()
+        await self.api("POST", "/_config", {"latency": self.args.latency, "retry_after_every": self.args.retry_after_every})
+        await self.api("POST", "/_reset")
+        self.bot.get_storage().flush()  # подготовката не се брои
+        self.bytes_at_start = self.disk_bytes()
+
+    async def finish(self) -> Dict:
+        # Application.stop изчаква фоновите задачи (обединени редакции, известия)
+        await self.app.stop()
+        await self.bot.cleanup_job(self.context)
+        await self.bot.API.stop(timeout=120)
+        await self.app.shutdown()
+        self.bot.get_storage().flush()
+        stats = await self.api("GET", "/_stats")
+        written = self.disk_bytes() - self.bytes_at_start
+        self.bot.STATE.close()
+        self.bot.close_storage()
+        return {"api_calls": stats["total"], "api_by_method": stats["by_method"], "bytes_written": written}
+
+    def disk_bytes(self) -> int:
+        storage = self.bot.get_storage()
+        if hasattr(storage, "bytes_written"):
+            return storage.bytes_written
+        wal = self.bot.DB_FILE + "-wal"
+        return os.path.getsize(wal) if os.path.exists(wal) else 0
+
+    async def feed(self, raw: Dict) -> None:
+        from telegram import Update
+        update = Update.de_json(raw, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.latencies.append(time.perf_counter() - started)
+        self.updates += 1
+
+    def enable(self, topics: int, at_now: bool = False) -> None:
+        now = datetime.now(self.bot.TIMEZONE)
+        for t in range(1, topics + 1):
+            self.bot.enable_topic(CHAT_ID, t)
+            if at_now:
+                self.bot.set_topic_time(self.bot.topic_key(CHAT_ID, t), (now.hour, now.minute))
+        if at_now:
+            # Topics са активирани „вчера“: enable_topic след часа им отбелязва днешния ден
+            self.bot.get_storage().set_meta("daily_done", {})
+
+    def report(self, name: str, wall: float, extra: Dict) -> Dict:
+        lat = self.latencies
+        out = {
+            "scenario": name,
+            "storage": self.bot.STORAGE,
+            "updates": self.updates,
+            "wall_s": round(wall, 3),
+            "updates_per_s": round(self.updates / wall, 1) if wall and self.updates else 0,
+            "p50_ms": round(percentile(lat, 50) * 1000, 3),
+            "p99_ms": round(percentile(lat, 99) * 1000, 3),
+        }
+        out.update(extra)
+        if self.updates:
+            out["api_calls_per_update"] = round(extra["api_calls"] / self.updates, 2)
+        return out
+
+    # --- сценарии ---
+    async def scenario_burst(self) -> Dict:
+        """Пакет добавяния в няколко Topics едновременно."""
+        topics, items = self.args.topics_small, self.args.items
+        self.enable(topics)
+        await self.start()
+        ups = [text_update(1 + i % topics, f"Артикул {i}") for i in range(items)]
+        started = time.perf_counter()
+        await asyncio.gather(*(self.feed(u) for u in ups))
+        handled = time.perf_counter() - started
+        res = await self.finish()
+        res["handled_s"] = round(handled, 3)
+        return self.report("burst", time.perf_counter() - started, res)
+
+    async def scenario_parallel(self) -> Dict:
+        """Стотици паралелни добавяния в един Topic – нито едно не бива да се загуби."""
+        n = self.args.items
+        self.enable(1)
+        await self.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(self.feed(text_update(1, f"p{i}")) for i in range(n)))
+        stored = self.bot.get_today(self.bot.topic_key(CHAT_ID, 1))
+        res = await self.finish()
+        res["stored"] = len(stored)
+        res["lost"] = n - len(stored)
+        res["in_order"] = stored == [f"p{i}" for i in range(n)]
+        return self.report("parallel", time.perf_counter() - started, res)
+
+    async def scenario_edit(self) -> Dict:
+        """Дълга /edit сесия върху голям списък: смяна, преместване и изтриване."""
+        size, ops = self.args.list_size, self.args.ops
+        self.enable(1)
+        k = self.bot.topic_key(CHAT_ID, 1)
+        self.bot.append_items(k, [f"ред {i}" for i in range(size)])
+        await self.start()
+        rnd = random.Random(1)
+        started = time.perf_counter()
+        for i in range(ops):
+            n = len(self.bot.get_today(k))
+            kind = ("set", "move", "del")[i % 3]
+            await self.feed(command_update(1, "/edit"))
+            await self.feed(callback_update(1, f"edit_{kind}"))
+            wid = self.bot.STATE.wizard(USER["id"], k)["id"]
+            await self.feed(callback_update(1, f"pick_{wid}_{rnd.randint(1, n)}"))
+            if kind == "set":
+                await self.feed(text_update(1, f"сменен {i}"))
+            elif kind == "move":
+                await self.feed(callback_update(1, f"pickto_{wid}_{rnd.randint(1, n)}"))
+        res = await self.finish()
+        return self.report("edit", time.perf_counter() - started, res)
+
+    async def scenario_fanout(self) -> Dict:
+        """Дневното съобщение за N Topics наведнъж (10:00)."""
+        self.enable(self.args.topics, at_now=True)
+        await self.start()
+        started = time.perf_counter()
+        await self.bot.daily_sweep_job(self.context)
+        swept = time.perf_counter() - started
+        res = await self.finish()
+        res["topics"] = self.args.topics
+        res["sweep_s"] = round(swept, 3)
+        return self.report("fanout", time.perf_counter() - started, res)
+
+    async def scenario_history(self) -> Dict:
+        """Години история в хранилището: старт и цена на едно добавяне."""
+        days, topics = self.args.days, self.args.topics_small
+        generate_history(days, topics, 15)
+        self.bot.close_storage()
+        self.bot.STATE.close()
+        os.remove(self.bot.STATE_FILE)  # снимката се строи наново от генерираната история
+        load_started = time.perf_counter()
+        self.bot.get_storage().load()
+        load_s = time.perf_counter() - load_started
+        self.bot.STATE.load()
+        await self.start()
+        started = time.perf_counter()
+        for i in range(self.args.items):
+            await self.feed(text_update(1 + i % topics, f"нов {i}"))
+        res = await self.finish()
+        res["history_days"] = days
+        res["load_s"] = round(load_s, 3)
+        return self.report("history", time.perf_counter() - started, res)
+
+def generate_history(days: int, topics: int, per_day: int) -> None:
+    """Записва order_data.json (и импортира в SQLite, ако е избран) с days дни история."""
+    import advancing_query_bot as bot
+    today = datetime.now(bot.TIMEZONE)
+    lists: Dict[str, Dict[str, List[str]]] = {}
+    for t in range(1, topics + 1):
+        k = bot.topic_key(CHAT_ID, t)
+        lists[k] = {
+            (today - timedelta(days=d)).strftime("%Y-%m-%d"): [f"артикул {d}-{i}" for i in range(per_day)]
+            for d in range(1, days + 1)
+        }
+    data = {"enabled_topics": list(lists), "lists": lists, "list_msgs": {}}
+    with open(bot.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    if bot.STORAGE == "sqlite":
+        storage = bot.SqliteStorage(bot.DB_FILE)
+        storage.import_data(data)
+        storage.close()
+
+async def scenario_shards(args: argparse.Namespace) -> Dict:
+    """Координатор + --shards работни процеса: ъпдейти от --chats чата през webhook входа.
+    Проверява, че всеки чат е само в своя шард, без загуби и в ред, и после преразпределя."""
+    import httpx
+    import advancing_query_bot as bot
+    router_port, base_port = args.port + 1, args.port + 2
+    env = dict(os.environ, TOKEN=TOKEN, BOT_API_URL=args.api, BOT_MODE="webhook", WEBHOOK_URL="",
+               WEBHOOK_SECRET="", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(router_port),
+               SHARD_BASE_PORT=str(base_port))
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "advancing_query_bot.py"), "run",
+                             "--shards", str(args.shards)], env=env, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{router_port}"
+    chats = [CHAT_ID - i for i in range(args.chats)]
+    per_chat = max(1, args.items // args.chats)
+    latencies: List[float] = []
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        for _ in range(300):
+            try:
+                if (await client.get(url + "/healthz")).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+        else:
+            proc.kill()
+            raise RuntimeError("координаторът не стартира")
+
+        async def post(raw: Dict) -> None:
+            started = time.perf_counter()
+            r = await client.post(url + "/telegram", json=raw)
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+        async def one_chat(chat_id: int) -> None:
+            for i in range(per_chat):
+                await post(text_update(1, f"{chat_id}:{i}", chat_id=chat_id))
+
+        async def setup_chat(chat_id: int) -> None:
+            await post(command_update(1, "/enable", chat_id=chat_id))
+            # Дневното съобщение (и изчистването) да не попадне в измерването
+            await post(command_update(1, f"/time {away:%H:%M}", chat_id=chat_id))
+
+        away = datetime.now(bot.TIMEZONE) + timedelta(hours=12)
+        await asyncio.gather(*(setup_chat(c) for c in chats))
+        await client.post(args.api + "/_reset")
+        started = time.perf_counter()
+        await asyncio.gather(*(one_chat(c) for c in chats))
+        wall = time.perf_counter() - started
+        shard_stats = (await client.get(url + "/_shards")).json()
+        proc.send_signal(signal.SIGTERM)
+        await asyncio.to_thread(proc.wait, 60)
+        stats = (await client.get(args.api + "/_stats")).json()
+
+    def check(count: int) -> Dict:
+        day = bot.today_key()
+        stored, lost, misplaced, in_order = 0, 0, 0, True
+        for i in range(count):
+            files = bot.shard_files(i, count)
+            storage = bot.open_storage(files["data"], files["db"])
+            for c in chats:
+                items = storage.get_items(bot.topic_key(c, 1), day)
+                if items and bot.shard_for(c, count) != i:
+                    misplaced += 1
+                if bot.shard_for(c, count) == i:
+                    stored += len(items)
+                    lost += per_chat - len(items)
+                    in_order = in_order and items == [f"{c}:{n}" for n in range(per_chat)]
+            storage.close()
+        return {"stored": stored, "lost": lost, "misplaced": misplaced, "in_order": in_order}
+
+    res = check(args.shards)
+    reb = bot.rebalance_shards(args.shards + 1)
+    after = check(args.shards + 1)
+    return {
+        "scenario": "shards",
+        "storage": bot.STORAGE,
+        "shards": args.shards,
+        "updates": len(latencies) - 2 * len(chats),
+        "wall_s": round(wall, 3),
+        "updates_per_s": round(per_chat * len(chats) / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "api_calls": stats["total"],
+        "api_by_method": stats["by_method"],
+        "per_shard": [s["forwarded"] for s in shard_stats],
+        **res,
+        "rebalance_ms": reb["ms"],
+        "lost_after_rebalance": after["lost"],
+        "misplaced_after_rebalance": after["misplaced"],
+    }
+
+def _remove_data_files(bot) -> None:
+    for path in (bot.DATA_FILE, bot.DATA_FILE + ".journal", bot.DB_FILE, bot.DB_FILE + "-wal",
+                 bot.DB_FILE + "-shm", bot.STATE_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+async def scenario_startup(args: argparse.Namespace) -> Dict:
+    """Рестарт при растящ брой Topics: след колко време ботът приема ъпдейти (без стартова
+    снимка и със) и колко трае пълното зареждане във фонов поток. Накрая прекъсва /edit с
+    рестарт и проверява, че следващият текст е редакцията, а не нов артикул."""
+    import advancing_query_bot as bot
+    # В хранилището стоят само HISTORY_HOT_DAYS дни – по-старите са в архива
+    days = min(args.days, bot.HISTORY_HOT_DAYS)
+    out: Dict = {"scenario": "startup", "storage": bot.STORAGE, "history_days": days}
+    for topics in (max(1, args.topics // 10), args.topics, args.topics * 5):
+        _remove_data_files(bot)
+        generate_history(days, topics, 15)
+        started = time.perf_counter()
+        bot.build_application(TOKEN, api_url=args.api)  # без STATE_FILE: строи се от хранилището
+        cold = time.perf_counter() - started
+        bot.STATE.close()
+        bot.close_storage()
+
+        started = time.perf_counter()
+        bot.build_application(TOKEN, api_url=args.api)
+        ready = time.perf_counter() - started
+        started = time.perf_counter()
+        await bot.warm_up()
+        loaded = time.perf_counter() - started
+        bot.STATE.close()
+        bot.close_storage()
+        out[f"t{topics}_cold_ms"] = round(cold * 1000, 1)
+        out[f"t{topics}_ready_ms"] = round(ready * 1000, 1)
+        out[f"t{topics}_load_ms"] = round(loaded * 1000, 1)
+
+    _remove_data_files(bot)
+    bench = Bench(args)
+    bench.enable(1)
+    k = bot.topic_key(CHAT_ID, 1)
+    bot.append_items(k, [f"ред {i}" for i in range(5)])
+    await bench.start()
+    await bench.feed(command_update(1, "/edit"))
+    await bench.feed(callback_update(1, "edit_set"))
+    wid = bot.STATE.wizard(USER["id"], k)["id"]
+    await bench.feed(callback_update(1, f"pick_{wid}_2"))
+    await asyncio.sleep(bot.STATE_SAVE_DELAY + 0.2)
+    on_disk = bot.StartupState(bot.STATE_FILE)
+    out["wizard_on_disk"] = (on_disk.wizard(USER["id"], k) or {}).get("await") == "text"
+    await bench.finish()
+
+    bench = Bench(args)
+    await bench.start()
+    await bench.feed(text_update(1, "сменен"))
+    items = bot.get_today(k)
+    await bench.finish()
+    out["wizard_after_restart"] = items == ["ред 0", "сменен", "ред 2", "ред 3", "ред 4"]
+    return out
+
+async def run_scenario(args: argparse.Namespace) -> Dict:
+    if args.scenario == "shards":
+        return await scenario_shards(args)
+    if args.scenario == "startup":
+        return await scenario_startup(args)
+    bench = Bench(args)
+    return await getattr(bench, "scenario_" + args.scenario)()
+
+# ------------------ ОРКЕСТРАЦИЯ ------------------
+def start_fake_api(port: int) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_bot_api.py"), "--port", str(port)],
+        stdout=subprocess.PIPE, text=True, cwd=HERE,
+    )
+    line = proc.stdout.readline()
+    if "Fake Bot API" not in line:
+        proc.kill()
+        raise RuntimeError("fake_bot_api.py не стартира")
+    return proc
+
+def bench_env(args: argparse.Namespace) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "STORAGE": args.storage,
+        "PYTHONPATH": HERE + os.pathsep + env.get("PYTHONPATH", ""),
+        "LIST_EDIT_DEBOUNCE": str(args.debounce),
+        "LIST_EDIT_MAX_DELAY": str(max(args.debounce * 4, 0.5)),
+        "DAILY_BATCH_JITTER": "0.05",
+    })
+    if not args.real_limits:
+        # Измерваме самия бот, а не лимитите на Telegram
+        env.update({"API_GLOBAL_RATE": "100000", "API_GROUP_PER_MIN": "6000000", "API_PRIVATE_RATE": "100000"})
+    return env
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарки на бота срещу fake_bot_api.py.")
+    parser.add_argument("scenarios", nargs="*", help="от: " + ", ".join(SCENARIOS) + " (по подразбиране всички)")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--items", type=int, default=500, help="ъпдейти в burst/parallel/history")
+    parser.add_argument("--topics", type=int, default=200, help="Topics във fanout (в startup: /10, ×1 и ×5)")
+    parser.add_argument("--topics-small", type=int, default=10, help="Topics в burst/history")
+    parser.add_argument("--list-size", type=int, default=300, help="редове в списъка за edit")
+    parser.add_argument("--ops", type=int, default=60, help="операции в edit")
+    parser.add_argument("--days", type=int, default=730, help="дни история в history")
+    parser.add_argument("--shards", type=int, default=2, help="работни процеса в shards")
+    parser.add_argument("--chats", type=int, default=20, help="чатове в shards")
+    parser.add_argument("--latency", type=float, default=0.0, help="забавяне на fake API (сек.)")
+    parser.add_argument("--retry-after-every", type=int, default=0, help="всяко N-то извикване → 429")
+    parser.add_argument("--debounce", type=float, default=0.2, help="LIST_EDIT_DEBOUNCE за бенчмарка")
+    parser.add_argument("--real-limits", action="store_true", help="с истинските лимити на Telegram")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--out", help="запиши резултатите и във файл (JSON lines)")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--api", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("непознати сценарии: " + ", ".join(sorted(unknown)))
+
+    if args.scenario:  # дъщерен процес
+        print(json.dumps(asyncio.run(run_scenario(args)), ensure_ascii=False))
+        return
+
+    fake = start_fake_api(args.port)
+    results = []
+    try:
+        child_args = [a for a in (argv if argv is not None else sys.argv[1:]) if a not in SCENARIOS]
+        for name in args.scenarios or SCENARIOS:
+            with tempfile.TemporaryDirectory() as workdir:
+                proc = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), *child_args,
+                     "--scenario", name, "--api", f"http://127.0.0.1:{args.port}"],
+                    cwd=workdir, env=bench_env(args), capture_output=True, text=True,
+                )
+            if proc.returncode != 0:
+                print(f"{name}: FAILED\n{proc.stderr[-2000:]}", file=sys.stderr)
+                continue
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            by_method = result.pop("api_by_method", {})
+            print(" ".join(f"{k}={v}" for k, v in result.items()))
+            print("    api:", " ".join(f"{k}={v}" for k, v in sorted(by_method.items())))
+    finally:
+        fake.terminate()
+        fake.wait()
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main()
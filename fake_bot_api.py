@@ -0,0 +1,186 @@
+# fake_bot_api.py
+# Локален заместител на Telegram Bot API за бенчмарки и тестове "от край до край".
+# Отговаря на методите, които ботът ползва, записва всяко извикване и може да добавя
+# забавяне и RetryAfter (429). Ботът се насочва към него с BOT_API_URL=http://127.0.0.1:<порт>.
+#
+#   python fake_bot_api.py --port 8081 --latency 0.05 --retry-after-every 50
+#
+# Служебни адреси: GET /_stats (брой извиквания по метод), GET /_calls (пълен запис),
+# POST /_reset (нулира записа), POST /_config {"latency": .., "retry_after_every": .., ...}.
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from advancing_query_bot import HttpServer, HttpResponse
+
+# Параметри, които PTB праща като суров текст (всички останали са JSON-кодирани)
+_RAW_STRING_PARAMS = {"text", "caption", "callback_query_id", "file_id", "url", "secret_token", "query"}
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 retry_after_every: int = 0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_every = retry_after_every
+        self.retry_after = retry_after
+        self.calls: List[Dict] = []
+        self.files: Dict[str, bytes] = {}
+        self._message_ids = itertools.count(1000)
+        self._counter = 0
+        self.server = HttpServer(host, port, {
+            ("POST", "/bot*"): self._api,
+            ("GET", "/bot*"): self._api,
+            ("GET", "/file/bot*"): self._file,
+            ("GET", "/_stats"): self._stats,
+            ("GET", "/_calls"): self._calls,
+            ("POST", "/_reset"): self._reset,
+            ("POST", "/_config"): self._config,
+        })
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}"
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def close(self) -> None:
+        await self.server.close(timeout=1.0)
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        self.files[file_id] = content
+
+    # --- служебни ---
+    def stats(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for call in self.calls:
+            out[call["method"]] = out.get(call["method"], 0) + 1
+        return out
+
+    async def _stats(self, request: Dict) -> HttpResponse:
+        return _json(200, {"total": len(self.calls), "by_method": self.stats()})
+
+    async def _calls(self, request: Dict) -> HttpResponse:
+        return _json(200, self.calls)
+
+    async def _reset(self, request: Dict) -> HttpResponse:
+        self.calls.clear()
+        self._counter = 0
+        return _json(200, {"ok": True})
+
+    async def _config(self, request: Dict) -> HttpResponse:
+        for key, value in json.loads(request["body"] or b"{}").items():
+            if key in ("latency", "jitter", "retry_after_every", "retry_after"):
+                setattr(self, key, value)
+        return _json(200, {"ok": True})
+
+    # --- Bot API ---
+    async def _file(self, request: Dict) -> HttpResponse:
+        file_path = request["path"].split("/", 3)[-1]
+        content = self.files.get(file_path)
+        if content is None:
+            return 404, "text/plain", b"not found"
+        return 200, "application/octet-stream", content
+
+    async def _api(self, request: Dict) -> HttpResponse:
+        method = request["path"].rsplit("/", 1)[-1]
+        params = _parse_params(request)
+        self._counter += 1
+        self.calls.append({"method": method, "params": params, "t": time.time()})
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.retry_after_every and self._counter % self.retry_after_every == 0:
+            return _json(429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        handler = getattr(self, "m_" + method.lower(), None)
+        if handler is None:
+            return _json(200, {"ok": True, "result": True})
+        return _json(200, {"ok": True, "result": handler(params)})
+
+    def _message(self, params: Dict, **extra) -> Dict:
+        chat_id = int(params.get("chat_id", 0))
+        msg = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+        }
+        if params.get("message_thread_id"):
+            msg["message_thread_id"] = int(params["message_thread_id"])
+            msg["is_topic_message"] = True
+        msg.update(extra)
+        return msg
+
+    def m_getme(self, params: Dict) -> Dict:
+        return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot",
+                "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+    def m_sendmessage(self, params: Dict) -> Dict:
+        return self._message(params, text=str(params.get("text", "")))
+
+    def m_editmessagetext(self, params: Dict) -> Dict:
+        msg = self._message(params, text=str(params.get("text", "")))
+        msg["message_id"] = int(params.get("message_id", 0))
+        return msg
+
+    def m_senddocument(self, params: Dict) -> Dict:
+        return self._message(params, document={"file_id": "doc", "file_unique_id": "doc"})
+
+    def m_getfile(self, params: Dict) -> Dict:
+        file_id = str(params.get("file_id"))
+        return {"file_id": file_id, "file_unique_id": file_id,
+                "file_size": len(self.files.get(file_id, b"")), "file_path": file_id}
+
+def _parse_params(request: Dict) -> Dict:
+    body = request["body"]
+    if not body:
+        return {}
+    if request["headers"].get("content-type", "").startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for key, value in parse_qsl(body.decode("utf-8"), keep_blank_values=True):
+        if key in _RAW_STRING_PARAMS:
+            params[key] = value
+            continue
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+def _json(status: int, payload) -> HttpResponse:
+    return status, "application/json", json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+async def _serve(args: argparse.Namespace) -> None:
+    api = FakeBotApi(args.host, args.port, args.latency, args.jitter, args.retry_after_every, args.retry_after)
+    await api.start()
+    print(f"Fake Bot API on {api.url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.close()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Локален заместител на Telegram Bot API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="забавяне на всяко извикване (сек.)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайно добавъчно забавяне (сек.)")
+    parser.add_argument("--retry-after-every", type=int, default=0, help="всяко N-то извикване връща 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    try:
+        asyncio.run(_serve(parser.parse_args(argv)))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
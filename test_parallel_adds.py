@@ -0,0 +1,45 @@
+# test_parallel_adds.py
+# Стотици паралелни добавяния в един Topic през build_application срещу fake_bot_api.py:
+# нито едно не бива да се загуби, а редът да остане този на пристигане.
+#
+#   python -m pytest -q test_parallel_adds.py
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import bench_bot
+
+ITEMS = 300
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def fake_api():
+    port = _free_port()
+    proc = bench_bot.start_fake_api(port)
+    yield f"http://127.0.0.1:{port}"
+    proc.terminate()
+    proc.wait()
+
+@pytest.mark.parametrize("storage", ["json", "sqlite"])
+def test_parallel_adds_are_not_lost(fake_api, storage, tmp_path):
+    args = argparse.Namespace(storage=storage, debounce=0.2, real_limits=False)
+    proc = subprocess.run(
+        [sys.executable, bench_bot.__file__, "--scenario", "parallel", "--api", fake_api,
+         "--items", str(ITEMS), "--latency", "0.005"],
+        cwd=tmp_path, env=bench_bot.bench_env(args), capture_output=True, text=True, timeout=300,
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    assert result["storage"] == storage
+    assert result["stored"] == ITEMS
+    assert result["lost"] == 0
+    assert result["in_order"] is True